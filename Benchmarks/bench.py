@@ -0,0 +1,354 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'File Crypto'))
+sys.path.insert(0, os.path.join(ROOT, 'Network'))
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden.json')
+
+# Everything below is generated from fixed seeds, so no game data is needed
+# and the golden digests are stable across runs.
+KEY_SEEDS = (0x12345678, 0x0BADF00D, 0x7F3C21A4)
+PACKET_SIZES = (16, 64, 256, 1024)
+ROUND_COUNTS = (1, 2, 4, 8)
+# Seconds a fresh interpreter may take to import the crypto module and build
+# its first cipher (or key); reported as within_budget, not enforced.
+COLD_START_BUDGET = 0.25
+
+COLD_START_DAT = '''
+import time
+start = time.perf_counter()
+import datdecrypt
+imported = time.perf_counter()
+datdecrypt.Cipher(bytes(16))
+print(imported - start, time.perf_counter() - imported)
+'''
+COLD_START_NET = '''
+import sys, time
+start = time.perf_counter()
+import talescrypto
+imported = time.perf_counter()
+talescrypto.load_keyblob(sys.argv[1])
+talescrypto.PacketCipher(talescrypto.gen_key(0x12345678))
+print(imported - start, time.perf_counter() - imported)
+'''
+
+
+def _rng(name):
+    return random.Random(name)
+
+
+def synthetic_keys(count, name='keys'):
+    rng = _rng(name)
+    return [rng.randbytes(16) for _ in range(count)]
+
+
+def write_keyblob(directory):
+    path = os.path.join(directory, 'keyblob.bin')
+    with open(path, 'wb') as f:
+        f.write(_rng('keyblob').randbytes(0x10000 + 0x100))
+    return path
+
+
+def write_dat_fixture(directory, count=2000, name='dt_09999.dat'):
+    from datwriter import ArchiveWriter
+
+    rng = _rng(name)
+    path = os.path.join(directory, name)
+    writer = ArchiveWriter(path, pad=rng.randbytes)
+    for i in range(count):
+        writer.add(f"data\\bench\\{i:05d}.bin", rng.randbytes(rng.randrange(16, 256)), filekey=rng.randbytes(16))
+    writer.write(workers=0)
+    return path
+
+
+def timeit(func, repeat=5, number=1):
+    # Best of `repeat` runs of `number` calls, in seconds per call.
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def digest(data):
+    return hashlib.sha256(bytes(data)).hexdigest()
+
+
+def cold_start(code, *args, repeat=3):
+    # Best of `repeat` fresh interpreters: import time, first use time and
+    # the whole process wall time.
+    env = dict(os.environ)
+    paths = [os.path.join(ROOT, 'File Crypto'), os.path.join(ROOT, 'Network'), env.get('PYTHONPATH')]
+    env['PYTHONPATH'] = os.pathsep.join(p for p in paths if p)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', code, *args], env=env, capture_output=True, text=True, check=True).stdout
+        wall = time.perf_counter() - start
+        imported, first = map(float, out.split())
+        if best is None or imported + first < best[0] + best[1]:
+            best = (imported, first, wall)
+    imported, first, wall = best
+    return {'import_s': imported, 'first_use_s': first, 'process_s': wall, 'budget_s': COLD_START_BUDGET, 'within_budget': imported + first <= COLD_START_BUDGET}
+
+
+class Run:
+
+    def __init__(self, quick):
+        self.scale = 0.1 if quick else 1.0
+        self.results = {}
+        self.vectors = {}
+        self.failures = []
+
+    def n(self, count):
+        return max(1, int(count * self.scale))
+
+    def check(self, name, ok):
+        # Cross-checks between engines; these need no recorded golden value.
+        if not ok:
+            self.failures.append(name)
+
+    def bench_file_crypto(self, workdir):
+        import datreference
+        import dattables
+        from datarchive import Archive
+        from datdecrypt import Cipher, StreamDecryptor
+
+        self.results['dat.cold_start'] = cold_start(COLD_START_DAT)
+
+        keys = synthetic_keys(self.n(200))
+        per_setup = timeit(lambda: [Cipher(k) for k in keys], repeat=3) / len(keys)
+        self.results['dat.key_schedule'] = {'setups_per_s': 1 / per_setup}
+
+        size = self.n(4 * 1024 * 1024) // 64 * 64
+        buffer = bytearray(size)
+        seconds = timeit(lambda: Cipher(keys[0]).keystream_into(buffer, size), repeat=3)
+        self.results['dat.keystream'] = {'bytes': size, 'mb_per_s': size / seconds / 1e6}
+
+        data = _rng('ciphertext').randbytes(size)
+        seconds = timeit(lambda: Cipher(keys[0]).stream_decrypt(data, size), repeat=3)
+        self.results['dat.stream_decrypt.large'] = {'bytes': size, 'mb_per_s': size / seconds / 1e6}
+        small = min(size, self.n(256 * 1024))
+
+        def small_calls():
+            cipher = Cipher(keys[0])
+            for pos in range(0, small, 4):
+                cipher.stream_decrypt(data[pos:pos + 4], 4)
+        seconds = timeit(small_calls, repeat=3)
+        self.results['dat.stream_decrypt.small'] = {'bytes': small, 'call_bytes': 4, 'mb_per_s': small / seconds / 1e6}
+
+        def streamed():
+            for _ in StreamDecryptor(Cipher(keys[0]), data, size).iter_chunks():
+                pass
+        seconds = timeit(streamed, repeat=3)
+        self.results['dat.stream_decryptor'] = {'bytes': size, 'mb_per_s': size / seconds / 1e6}
+
+        # Known-answer vectors, compared against golden.json. They come from
+        # datreference (the original cipher code), and every engine is
+        # checked against them. Their inputs do not depend on --quick.
+        self.vectors['dat.tables'] = digest(b''.join(struct.pack('<256I', *getattr(datreference, name)) for name in dattables.TABLE_NAMES))
+        reference = datreference.Cipher(keys[0])
+        reference._ensure_keystream(4096)
+        ref_keystream = bytes(reference.keystream_buffer)
+        self.vectors['dat.keystream'] = digest(ref_keystream)
+        vector = _rng('vector').randbytes(4096)
+        ref_plain = datreference.Cipher(keys[1]).stream_decrypt(vector, 4096)
+        self.vectors['dat.stream_decrypt'] = digest(ref_plain)
+        self._check_dat_engines(keys, ref_keystream, vector, ref_plain)
+
+        start = time.perf_counter()
+        path = write_dat_fixture(workdir, 500)
+        self.results['dat.archive_write'] = {'entries': 500, 'seconds': time.perf_counter() - start}
+        seconds = timeit(lambda: Archive(path).close(), repeat=3)
+        with Archive(path) as archive:
+            count = len(archive)
+            table, ref_table = hashlib.sha256(), hashlib.sha256()
+            for entry in archive:
+                table.update(repr(tuple(entry)).encode())
+                archive.extract(entry.name, table)
+                ref_table.update(repr(tuple(entry)).encode())
+                payload = archive.payload(entry.name)
+                ref_table.update(datreference.Cipher(entry.filekey).stream_decrypt(payload, entry.size) if entry.encrypted else payload)
+        self.results['dat.archive_open'] = {'entries': count, 'seconds': seconds}
+        self.check('dat.archive == reference', table.digest() == ref_table.digest())
+        self.vectors['dat.archive'] = ref_table.hexdigest()
+
+    def _check_dat_engines(self, keys, ref_keystream, vector, ref_plain):
+        import datreference
+        from datdecrypt import Cipher, StreamDecryptor
+        from datwriter import encrypt_payload
+
+        keystream = bytearray(4096)
+        Cipher(keys[0]).keystream_into(keystream, 4096)
+        self.check('dat.keystream_into == reference', keystream == ref_keystream)
+        self.check('dat.stream_decrypt == reference', Cipher(keys[1]).stream_decrypt(vector, 4096) == ref_plain)
+        self.check('dat.stream_decryptor == reference', StreamDecryptor(Cipher(keys[1]), vector, 4096).read() == ref_plain)
+        # Field-sized calls that leave partial words buffered between them.
+        cipher, reference, pos, same = Cipher(keys[1]), datreference.Cipher(keys[1]), 0, True
+        for size in (4, 1, 4, 3, 16, 2, 7, 64, 5, 130):
+            same &= cipher.stream_decrypt(vector[pos:], size) == reference.stream_decrypt(vector[pos:], size)
+            pos += size
+        self.check('dat.stream_decrypt small calls == reference', same)
+        seeker = Cipher(keys[0], checkpoint_interval=256)
+        for offset in (4095, 1000, 64, 3, 0, 2051, 2048):
+            seeker.seek(offset)
+            keystream = bytearray(4096 - offset)
+            seeker.keystream_into(keystream, len(keystream))
+            self.check(f'dat.seek({offset}) == reference', keystream == ref_keystream[offset:])
+        stream = StreamDecryptor(Cipher(keys[1]), vector, 4096)
+        stream.seek(1234)
+        self.check('dat.stream_decryptor.seek == reference', stream.read() == ref_plain[1234:])
+        self.check('dat.stream_encrypt == reference', Cipher(keys[1]).stream_encrypt(ref_plain, 4096) == vector)
+        self.check('dat.encrypt_payload == reference', encrypt_payload(keys[1], ref_plain, chunk_size=1000) == vector)
+        try:
+            import numpy as np
+            from datbatch import BatchCipher, batch_stream_decrypt
+        except ImportError:
+            return
+        matrix = np.frombuffer(b''.join(keys[:8]), dtype=np.uint8).reshape(8, 16)
+        batch = BatchCipher(matrix).keystream_blocks(4)
+        for i, key in enumerate(keys[:8]):
+            reference = datreference.Cipher(key)
+            reference._ensure_keystream(256)
+            self.check(f'dat.batch_keystream[{i}] == reference', bytes(batch[i]) == bytes(reference.keystream_buffer[:256]))
+        plain = batch_stream_decrypt(matrix[1:3], [vector, vector[:1000]])
+        self.check('dat.batch_stream_decrypt == reference', bytes(plain[0]) == ref_plain and bytes(plain[1]) == datreference.Cipher(keys[2]).stream_decrypt(vector, 1000))
+
+    def bench_network(self, workdir):
+        import talescrypto
+        from talescrypto import PacketCipher, decrypt, encrypt, gen_key, load_keyblob
+        from talesmetrics import Metrics
+
+        keyblob = write_keyblob(workdir)
+        self.results['net.cold_start'] = cold_start(COLD_START_NET, keyblob)
+
+        def cold():
+            load_keyblob(keyblob)
+            return [gen_key(seed) for seed in KEY_SEEDS]
+        cold_key = timeit(cold, repeat=3) / len(KEY_SEEDS)
+        keys = cold()
+        warm_key = timeit(lambda: [gen_key(seed) for seed in KEY_SEEDS], repeat=3, number=self.n(1000)) / len(KEY_SEEDS)
+        self.results['net.gen_key'] = {'cold_us': cold_key * 1e6, 'cached_us': warm_key * 1e6}
+        for seed, key in zip(KEY_SEEDS, keys):
+            self.vectors[f'net.gen_key.{seed:08x}'] = digest(key)
+
+        rng = _rng('packets')
+        for rounds in ROUND_COUNTS:
+            key = bytearray(keys[0])
+            key[0] = rounds
+            setup = timeit(lambda: PacketCipher(key), repeat=3)
+            self.results[f'net.r{rounds}.packet_cipher_setup'] = {'us': setup * 1e6}
+            cipher = PacketCipher(key)
+            for size in PACKET_SIZES:
+                packet = rng.randbytes(size)
+                framed = encrypt(key, packet, 1)
+                number = self.n(200 if size <= 256 else 50)
+                enc = timeit(lambda: encrypt(key, packet, 1), number=number)
+                dec = timeit(lambda: decrypt(key, framed), number=number)
+                plain = decrypt(key, framed)
+                name = f'net.r{rounds}.{size}'
+                table_enc = timeit(lambda: cipher.encrypt(packet, 1), number=number)
+                table_dec = timeit(lambda: cipher.decrypt(framed), number=number)
+                talescrypto.set_metrics(Metrics())
+                try:
+                    instrumented_dec = timeit(lambda: cipher.decrypt(framed), number=number)
+                finally:
+                    talescrypto.set_metrics(None)
+                self.results[name] = {
+                    'encrypt_us': enc * 1e6, 'decrypt_us': dec * 1e6,
+                    'packet_cipher_encrypt_us': table_enc * 1e6, 'packet_cipher_decrypt_us': table_dec * 1e6,
+                    'packet_cipher_decrypt_metrics_us': instrumented_dec * 1e6,
+                }
+                self.check(name + ' PacketCipher.encrypt == encrypt', cipher.encrypt(packet, 1) == framed)
+                self.check(name + ' PacketCipher.decrypt == decrypt', cipher.decrypt(framed) == plain)
+                self.vectors[name + '.encrypt'] = digest(framed)
+                self.vectors[name + '.decrypt'] = digest(plain)
+
+
+def compare(vectors, golden, record):
+    status = {}
+    for name, value in sorted(vectors.items()):
+        if record:
+            golden[name] = value
+            status[name] = 'recorded'
+        elif name not in golden:
+            # Unrecorded counts as a failure: record once with --record.
+            status[name] = 'unrecorded'
+        else:
+            status[name] = 'ok' if golden[name] == value else 'FAIL'
+    return status
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark and known-answer check of the DAT and network crypto.")
+    parser.add_argument('-o', '--output', help="write results as JSON to this file")
+    parser.add_argument('--quick', action='store_true', help="smaller inputs, for a fast smoke run")
+    parser.add_argument('--only', choices=('dat', 'net'), help="run a single subsystem")
+    parser.add_argument('--record', action='store_true', help="store the current outputs as the golden values")
+    args = parser.parse_args(argv)
+
+    run = Run(args.quick)
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.only in (None, 'dat'):
+            run.bench_file_crypto(workdir)
+        if args.only in (None, 'net'):
+            run.bench_network(workdir)
+
+    golden = {}
+    if os.path.exists(GOLDEN_PATH):
+        with open(GOLDEN_PATH) as f:
+            golden = json.load(f)
+    status = compare(run.vectors, golden, args.record)
+    if args.record:
+        with open(GOLDEN_PATH, 'w') as f:
+            json.dump(golden, f, indent=1, sort_keys=True)
+            f.write('\n')
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'quick': args.quick,
+        'results': run.results,
+        'golden': status,
+        'cross_check_failures': run.failures,
+    }
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    failed = [name for name, state in status.items() if state == 'FAIL'] + run.failures
+    if failed:
+        print("Known-answer mismatch: " + ", ".join(failed), file=sys.stderr)
+    unrecorded = [name for name, state in status.items() if state == 'unrecorded']
+    if unrecorded:
+        print("No golden value (run with --record against the real tables): " + ", ".join(unrecorded), file=sys.stderr)
+    if failed or unrecorded:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,456 @@
+import io
+import mmap
+import os
+import socket
+import stat
+import struct
+from array import array
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import datcache
+from datdecrypt import CHUNK_SIZE, KEYSTREAM_BLOCK_SIZE, Cipher, StreamDecryptor, calculate_checksums, generate_content_sbox, generate_header_key, to_uint32
+
+BASE_KEY = "VS#sg#^$sa2d34"
+HEADER_SIZE = 9
+COLUMNS = datcache.COLUMNS
+
+# WIP: the meaning of the unk fields is still a guess. Everything that
+# locates or sizes a payload goes through these names, so correcting the
+# layout is a one line change here.
+OFFSET_FIELD = 'unk1'
+SIZE_FIELD = 'unk2'
+ORIGINAL_SIZE_FIELD = 'unk3'
+
+_WORD = struct.Struct('<I')
+_WORDS = struct.Struct('<5I')
+_RECORD_TAIL = _WORDS.size + 16
+# Smallest metadata record: name length word, five uint32 fields, filekey.
+MIN_RECORD_SIZE = _WORD.size + _RECORD_TAIL
+
+
+class Entry(namedtuple('Entry', 'name unk1 cryptflag unk2 unk3 unk4 filekey')):
+    __slots__ = ()
+
+    @property
+    def offset(self):
+        return getattr(self, OFFSET_FIELD)
+
+    @property
+    def size(self):
+        return getattr(self, SIZE_FIELD)
+
+    @property
+    def original_size(self):
+        return getattr(self, ORIGINAL_SIZE_FIELD)
+
+    @property
+    def encrypted(self):
+        return self.cryptflag != 0
+
+
+class EntryTable:
+    """Column-oriented metadata table.
+
+    The uint32 fields live in one array('I') each, the filekeys in a single
+    N*16 byte block and the UTF-16 names in one blob addressed by
+    ``name_offsets``. Entry tuples are only built when asked for.
+    """
+
+    def __init__(self, names, name_offsets, filekeys, columns):
+        self.names = names
+        self.name_offsets = name_offsets
+        self.filekeys = filekeys
+        self.columns = columns
+        self._index = None
+
+    def __len__(self):
+        return len(self.name_offsets) - 1
+
+    def name(self, i):
+        return self.names[self.name_offsets[i]:self.name_offsets[i + 1]].decode('utf-16-le')
+
+    def filekey(self, i):
+        return self.filekeys[i * 16:i * 16 + 16]
+
+    def __getitem__(self, i):
+        if isinstance(i, str):
+            i = self.index(i)
+        elif i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Entry(self.name(i), *(self.columns[column][i] for column in COLUMNS), self.filekey(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def index(self, name):
+        # The name -> row dict is only built by the first lookup.
+        if self._index is None:
+            self._index = {self.name(i): i for i in range(len(self))}
+        return self._index[name]
+
+    def __contains__(self, name):
+        try:
+            self.index(name)
+        except KeyError:
+            return False
+        return True
+
+    @property
+    def offsets(self):
+        return self.columns[OFFSET_FIELD]
+
+    @property
+    def sizes(self):
+        return self.columns[SIZE_FIELD]
+
+    def select(self, **criteria):
+        # Row numbers whose columns equal every given value, e.g. select(cryptflag=0).
+        if np is not None:
+            mask = np.ones(len(self), dtype=bool)
+            for column, value in criteria.items():
+                mask &= np.frombuffer(self.columns[column], dtype=np.uint32) == value
+            return np.flatnonzero(mask)
+        rows = range(len(self))
+        for column, value in criteria.items():
+            data = self.columns[column]
+            rows = [i for i in rows if data[i] == value]
+        return list(rows)
+
+
+class MetadataDecoder:
+    # Per-field stream_decrypt without a Cipher call per field: the keystream
+    # for the table is generated in bulk, and because the borrow never crosses
+    # a field each 4-byte field is a plain uint32 subtraction. The first batch
+    # covers ``count`` records of the smallest size; later ones double what
+    # has been generated so far, never running past the end of the view.
+
+    def __init__(self, cipher, view, offset, count=0):
+        self.cipher = cipher
+        self.view = view
+        self.offset = offset
+        self.keystream = bytearray()
+        self.keystream_start = offset
+        self.generated = 0
+        self.estimate = count * MIN_RECORD_SIZE
+
+    def _keystream(self, length):
+        end = self.offset + length
+        have = self.keystream_start + len(self.keystream)
+        if end > have:
+            del self.keystream[:self.offset - self.keystream_start]
+            self.keystream_start = self.offset
+            grow = max(end - have, self.generated or self.estimate)
+            grow = -(-grow // KEYSTREAM_BLOCK_SIZE) * KEYSTREAM_BLOCK_SIZE
+            grow = max(end - have, min(grow, len(self.view) - have))
+            self.generated += grow
+            chunk = bytearray(grow)
+            self.cipher.keystream_into(chunk, grow)
+            self.keystream += chunk
+        return self.offset - self.keystream_start
+
+    def _check(self, length):
+        if self.offset + length > len(self.view):
+            raise ValueError(f"metadata read of {length} bytes at {self.offset} runs past end of file.")
+
+    def word(self):
+        self._check(4)
+        pos = self._keystream(4)
+        value = (_WORD.unpack_from(self.view, self.offset)[0] - _WORD.unpack_from(self.keystream, pos)[0]) & 0xFFFFFFFF
+        self.offset += 4
+        return value
+
+    def words(self):
+        self._check(_WORDS.size)
+        pos = self._keystream(_WORDS.size)
+        values = [(c - k) & 0xFFFFFFFF for c, k in zip(_WORDS.unpack_from(self.view, self.offset), _WORDS.unpack_from(self.keystream, pos))]
+        self.offset += _WORDS.size
+        return values
+
+    def block(self, length):
+        self._check(length)
+        pos = self._keystream(length)
+        value = int.from_bytes(self.view[self.offset:self.offset + length], 'little') - int.from_bytes(self.keystream[pos:pos + length], 'little')
+        self.offset += length
+        return (value % (1 << (length * 8))).to_bytes(length, 'little')
+
+    def table(self, count):
+        names = bytearray()
+        name_offsets = array('I', [0])
+        filekeys = bytearray()
+        columns = {column: array('I') for column in COLUMNS}
+        appends = [columns[column].append for column in COLUMNS]
+        for _ in range(count):
+            namelen = self.word() * 2
+            if namelen:
+                names += self.block(namelen)
+            name_offsets.append(len(names))
+            self._check(_RECORD_TAIL)
+            for append, value in zip(appends, self.words()):
+                append(value)
+            filekeys += self.block(16)
+        return EntryTable(bytes(names), name_offsets, bytes(filekeys), columns)
+
+
+class PayloadReader(io.RawIOBase):
+    # Plain counterpart of StreamDecryptor for entries stored unencrypted.
+
+    def __init__(self, view):
+        self._view = view
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._offset
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._offset = max(0, min(offset, len(self._view)))
+        return self._offset
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        n = min(len(out), len(self._view) - self._offset)
+        out[:n] = self._view[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+
+def _sink_writer(sink):
+    for name in ('write', 'sendall', 'update'):
+        write = getattr(sink, name, None)
+        if write is not None:
+            return write
+    raise TypeError(f"Can't write to {type(sink).__name__}.")
+
+
+def copy_range(src, sink, offset, size):
+    # Kernel-side copy of a plain payload when the sink is a real fd. Returns
+    # False if nothing was copied and the caller should fall back to writes.
+    if isinstance(sink, socket.socket):
+        sink.sendfile(src, offset, size)
+        return True
+    try:
+        out_fd = sink.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+    if hasattr(sink, 'flush'):
+        sink.flush()
+    in_fd = src.fileno()
+    if stat.S_ISREG(os.fstat(out_fd).st_mode) and hasattr(os, 'copy_file_range'):
+        copy = lambda pos, count: os.copy_file_range(in_fd, out_fd, count, pos)
+    elif hasattr(os, 'sendfile'):
+        copy = lambda pos, count: os.sendfile(out_fd, in_fd, pos, count)
+    else:
+        return False
+    done = 0
+    while done < size:
+        try:
+            n = copy(offset + done, size - done)
+        except OSError:
+            if done:
+                raise
+            return False
+        if n == 0:
+            raise ValueError(f"payload at {offset} truncated after {done} of {size} bytes.")
+        done += n
+    return True
+
+
+class Archive:
+    """Read-only view of a .dat archive.
+
+    The file is mmapped; only the header and the metadata table are decrypted
+    on open; payloads are handed out as memoryview slices of the map.
+
+    With ``cache`` set (True for a sidecar next to the archive, or a directory
+    path) the decoded table is kept in a datcache index and reused while the
+    archive's size, mtime and header bytes stay the same.
+    """
+
+    def __init__(self, path, base_key=BASE_KEY, cache=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.combined_string = self.name + base_key
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"{path}: empty file.")
+        self.view = memoryview(self._map)
+        self._checkpoints = {}
+        try:
+            self._locate()
+            table = None
+            if cache:
+                cache_path = datcache.cache_path(path, None if cache is True else cache)
+                cache_key = datcache.archive_key(path, os.fstat(self._file.fileno()), self._slice(0, self.metadata_offset))
+                table = datcache.load(cache_path, cache_key)
+            if table is None:
+                self._check_header()
+                self.entries = self._read_metadata()
+                if cache:
+                    datcache.store(cache_path, cache_key, self._table())
+            else:
+                self._load_table(table)
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._map is None:
+            return
+        self.view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # Payload views are still alive; the map goes away with the last one.
+            pass
+        self._file.close()
+        self._map = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def _slice(self, offset, length):
+        if offset + length > len(self.view):
+            raise ValueError(f"{self.name}: read of {length} bytes at {offset} runs past end of file.")
+        return self.view[offset:offset + length]
+
+    def _locate(self):
+        self.offset1, self.offset2_seed, _ = calculate_checksums(self.name)
+        self.header_key = generate_header_key(self.combined_string)
+        self.content_key = generate_content_sbox(self.combined_string, self.offset1 + self.offset2_seed)[:16]
+        self.metadata_offset = self.offset1 + HEADER_SIZE + self.offset2_seed
+
+    def _check_header(self):
+        header_cipher = Cipher(self.header_key)
+        offset = self.offset1
+        dword1 = struct.unpack('<I', header_cipher.stream_decrypt(self._slice(offset, 4), 4))[0]
+        self.version = header_cipher.stream_decrypt(self._slice(offset + 4, 1), 1)[0]
+        dword2 = struct.unpack('<I', header_cipher.stream_decrypt(self._slice(offset + 5, 4), 4))[0]
+        if dword1 != to_uint32(dword2 + self.version):
+            raise ValueError(f"{self.name}: header integrity failed.")
+        self.num_entries = dword2
+
+    def _read_metadata(self):
+        decoder = MetadataDecoder(Cipher(self.content_key), self.view, self.metadata_offset, self.num_entries)
+        try:
+            table = decoder.table(self.num_entries)
+        except ValueError as e:
+            raise ValueError(f"{self.name}: {e}")
+        self.metadata_end = decoder.offset
+        return table
+
+    def _table(self):
+        table = {
+            'version': self.version, 'num_entries': self.num_entries, 'metadata_end': self.metadata_end,
+            'name_offsets': self.entries.name_offsets, 'names': self.entries.names,
+            'filekeys': self.entries.filekeys,
+        }
+        table.update(self.entries.columns)
+        return table
+
+    def _load_table(self, table):
+        self.version = table['version']
+        self.num_entries = table['num_entries']
+        self.metadata_end = table['metadata_end']
+        columns = {column: table[column] for column in COLUMNS}
+        self.entries = EntryTable(table['names'], table['name_offsets'], table['filekeys'], columns)
+
+    def payload(self, name):
+        # Raw (still encrypted) payload bytes of an entry, without copying.
+        entry = self.entries[name]
+        return self._slice(entry.offset, entry.size)
+
+    def open(self, name, checkpoint_interval=None):
+        # Readable, seekable stream of an entry's plaintext, decrypted chunk by
+        # chunk. With checkpoint_interval the keystream snapshots are kept per
+        # filekey, so later opens of the same entry seek from the nearest one.
+        entry = self.entries[name]
+        payload = self._slice(entry.offset, entry.size)
+        if entry.encrypted and entry.size:
+            checkpoints = None
+            if checkpoint_interval:
+                checkpoints = self._checkpoints.setdefault((entry.filekey, checkpoint_interval), {})
+            cipher = Cipher(entry.filekey, checkpoint_interval, checkpoints)
+            return StreamDecryptor(cipher, payload, entry.size)
+        return PayloadReader(payload)
+
+    def extract(self, name, sink, chunk_size=CHUNK_SIZE):
+        # Streams an entry into a file, socket or hashlib object using at most
+        # chunk_size bytes of buffer; plain entries go through the kernel
+        # (copy_file_range/sendfile) when the sink has a file descriptor.
+        entry = self.entries[name]
+        payload = self._slice(entry.offset, entry.size)
+        if not entry.encrypted or not entry.size:
+            if entry.size and copy_range(self._file, sink, entry.offset, entry.size):
+                return entry.size
+            write = _sink_writer(sink)
+            for pos in range(0, entry.size, chunk_size):
+                write(payload[pos:pos + chunk_size])
+            return entry.size
+        write = _sink_writer(sink)
+        for chunk in StreamDecryptor(Cipher(entry.filekey), payload, entry.size).iter_chunks(chunk_size):
+            write(chunk)
+        return entry.size
+
+
+def main(argv):
+    for path in argv:
+        try:
+            archive = Archive(path)
+        except FileNotFoundError:
+            print(f"Error: The file '{path}' was not found.")
+            continue
+        except ValueError as e:
+            print(f"\nError: {e}")
+            continue
+        with archive:
+            print(f"Checksum Offset 1 (for header block): {archive.offset1}")
+            print(f"Checksum Offset 2 (seed for re-keying): {archive.offset2_seed}")
+            print(f"Header key: {archive.header_key.hex()}")
+            print(f"Header OK, version={archive.version}.")
+            print(f"Content key: {archive.content_key.hex()}")
+            print(f"\nDAT file contains {archive.num_entries} files.")
+            for entry in archive:
+                print(f"Filename: {entry.name}")
+                print(f"unk1: 0x{entry.unk1:08x}")
+                print(f"cryptflag: 0x{entry.cryptflag:08x}")
+                print(f"unk2: 0x{entry.unk2:08x}")
+                print(f"unk3: 0x{entry.unk3:08x}")
+                print(f"unk4: 0x{entry.unk4:08x}")
+                print(f"filekey: {entry.filekey.hex()}")
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
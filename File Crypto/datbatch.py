@@ -0,0 +1,107 @@
+import types
+
+import numpy as np
+
+import datdecrypt
+import dattables
+from datdecrypt import Cipher, KEYSTREAM_BLOCK_SIZE
+
+
+# The key schedule and sub_423450 only use the table lookups, BYTEn helpers,
+# to_uint32 and + ^ << >> ~ on their operands, all of which broadcast over
+# uint32 arrays. Instead of keeping a second hand-written copy of ~250 lines
+# of cipher rounds in sync, the scalar methods are rebound to the same module
+# namespace with the tables swapped for numpy arrays: every lookup becomes a
+# gather and every register holds one lane per key.
+# The arrays are views of dattables' array('I') buffers rather than copies
+# of datdecrypt's per-process lists, so forked workers share them.
+_GLOBALS = dict(vars(datdecrypt))
+for _name, _table in dattables.load(lists=False).items():
+    _GLOBALS[_name] = np.frombuffer(_table, dtype=np.uint32)
+
+
+def _rebind(func):
+    return types.FunctionType(func.__code__, _GLOBALS, func.__name__, func.__defaults__, func.__closure__)
+
+
+def _sign_extend(column):
+    column = column.astype(np.uint32)
+    return np.where(column > 127, column | np.uint32(0xFFFFFF00), column)
+
+
+class BatchCipher:
+    """N independent Cipher instances advanced in lock step.
+
+    ``keys`` is an (N, 16) uint8 array (or anything np.asarray turns into one).
+    Keystream is produced whole blocks at a time; unlike Cipher there is no
+    partial-word state, each call starts on a fresh 64-byte block.
+    """
+
+    _perform_round_update = _rebind(Cipher._perform_round_update)
+    _initialize_state_from_key = _rebind(Cipher._initialize_state_from_key)
+    _generate_key_schedule = _rebind(Cipher._generate_key_schedule)
+    sub_423450 = _rebind(Cipher.sub_423450)
+
+    def __init__(self, keys):
+        keys = np.asarray(keys, dtype=np.uint8)
+        if keys.ndim != 2 or keys.shape[1] != 16:
+            raise ValueError("Keys must be an (N, 16) array.")
+        self.key = keys
+        self.state = [0] * 256
+        self._generate_key_schedule()
+
+    def __len__(self):
+        return len(self.key)
+
+    def _load_signed_bigendian(self, key_bytes, offset=0):
+        val = _sign_extend(key_bytes[:, offset]) << 8
+        val |= _sign_extend(key_bytes[:, offset + 1])
+        val <<= 8
+        val |= _sign_extend(key_bytes[:, offset + 2])
+        val <<= 8
+        val |= _sign_extend(key_bytes[:, offset + 3])
+        return val
+
+    def keystream_blocks(self, count):
+        # Returns an (N, count * 64) uint8 array of keystream, one row per key.
+        words = np.empty((len(self), count, 16), dtype='<u4')
+        for block in range(count):
+            temp_state_slice = self.state[1:37]
+            self.sub_423450(temp_state_slice)
+            self.state[1:37] = temp_state_slice
+            words[:, block, :] = np.stack(self.state[21:37], axis=1)
+        return words.view(np.uint8).reshape(len(self), count * KEYSTREAM_BLOCK_SIZE)
+
+    def stream_decrypt(self, buffers):
+        # Per-key equivalent of Cipher(keys[i]).stream_decrypt(buffers[i], len(buffers[i])).
+        if len(buffers) != len(self):
+            raise ValueError("Expected one buffer per key.")
+        lengths = [len(b) for b in buffers]
+        width = max(lengths, default=0)
+        if width == 0:
+            return [bytearray() for _ in buffers]
+        blocks = -(-width // KEYSTREAM_BLOCK_SIZE)
+        data = np.zeros((len(self), width), dtype=np.uint8)
+        for row, buffer in enumerate(buffers):
+            data[row, :len(buffer)] = np.frombuffer(buffer, dtype=np.uint8)
+        out = subtract_with_borrow(data, self.keystream_blocks(blocks)[:, :width])
+        return [bytearray(out[row, :length]) for row, length in enumerate(lengths)]
+
+
+def subtract_with_borrow(data, keystream):
+    # Row-wise little-endian (data - keystream) mod 2**(8 * width). The borrow
+    # into byte i comes from the nearest lower byte where data != keystream,
+    # so it can be resolved with a running maximum instead of a serial loop.
+    # Zero padding past a row's real length never affects the bytes below it.
+    data = data.astype(np.int16)
+    keystream = keystream.astype(np.int16)
+    decided = np.where(data != keystream, np.arange(data.shape[1]), -1)
+    last = np.maximum.accumulate(decided, axis=1)
+    last = np.concatenate([np.full((data.shape[0], 1), -1), last[:, :-1]], axis=1)
+    generates = data < keystream
+    borrow = np.where(last >= 0, np.take_along_axis(generates, np.maximum(last, 0), axis=1), False)
+    return ((data - keystream - borrow) & 0xFF).astype(np.uint8)
+
+
+def batch_stream_decrypt(keys, buffers):
+    return BatchCipher(keys).stream_decrypt(buffers)
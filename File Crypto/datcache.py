@@ -0,0 +1,101 @@
+import hashlib
+import os
+import struct
+import sys
+from array import array
+
+from datfile import replace_atomically
+
+# Sidecar index of a decoded metadata table, so reopening an unchanged archive
+# needs no Cipher at all. Layout, all little-endian:
+#
+#   head      magic, format, key length
+#   key       archive size, mtime_ns, sha1 of the header region, abs path
+#   table     version, entry count, metadata end, names blob length
+#   columns   name_offsets[N+1], unk1[N], cryptflag[N], unk2[N], unk3[N],
+#             unk4[N] as uint32, then filekeys[N*16], then the UTF-16 names
+MAGIC = b'TWIX'
+FORMAT = 1
+SUFFIX = '.twidx'
+COLUMNS = ('unk1', 'cryptflag', 'unk2', 'unk3', 'unk4')
+
+_HEAD = struct.Struct('<4sII')
+_KEY = struct.Struct('<QQ20s')
+_TABLE = struct.Struct('<BIII')
+
+
+def cache_path(archive_path, cache_dir=None):
+    archive_path = os.path.abspath(archive_path)
+    if cache_dir is None:
+        return archive_path + SUFFIX
+    digest = hashlib.sha1(archive_path.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, os.path.basename(archive_path) + '-' + digest[:16] + SUFFIX)
+
+
+def archive_key(archive_path, stat, header_region):
+    path = os.path.abspath(archive_path).encode('utf-8')
+    return _KEY.pack(stat.st_size, stat.st_mtime_ns, hashlib.sha1(header_region).digest()) + path
+
+
+def _uint32s(data):
+    column = array('I')
+    column.frombytes(data)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+def _uint32_bytes(column):
+    column = array('I', column)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+
+def load(path, key):
+    # Returns the cached table for `key`, or None if missing or stale.
+    try:
+        with open(path, 'rb') as f:
+            data = memoryview(f.read())
+    except OSError:
+        return None
+    try:
+        magic, fmt, key_len = _HEAD.unpack_from(data, 0)
+        offset = _HEAD.size
+        if magic != MAGIC or fmt != FORMAT or data[offset:offset + key_len] != key:
+            return None
+        offset += key_len
+        version, count, metadata_end, names_len = _TABLE.unpack_from(data, offset)
+        offset += _TABLE.size
+        table = {'version': version, 'num_entries': count, 'metadata_end': metadata_end}
+        table['name_offsets'] = _uint32s(data[offset:offset + (count + 1) * 4])
+        offset += (count + 1) * 4
+        for column in COLUMNS:
+            table[column] = _uint32s(data[offset:offset + count * 4])
+            offset += count * 4
+        table['filekeys'] = bytes(data[offset:offset + count * 16])
+        offset += count * 16
+        table['names'] = bytes(data[offset:offset + names_len])
+        if offset + names_len != len(data):
+            return None
+    except (struct.error, ValueError):
+        return None
+    return table
+
+
+def store(path, key, table):
+    # Best effort: an unwritable cache location just means no cache.
+    names = table['names']
+    parts = [
+        _HEAD.pack(MAGIC, FORMAT, len(key)), key,
+        _TABLE.pack(table['version'], table['num_entries'], table['metadata_end'], len(names)),
+        _uint32_bytes(table['name_offsets']),
+    ]
+    parts.extend(_uint32_bytes(table[column]) for column in COLUMNS)
+    parts.append(table['filekeys'])
+    parts.append(names)
+    try:
+        with replace_atomically(path) as f:
+            f.write(b''.join(parts))
+    except OSError:
+        pass
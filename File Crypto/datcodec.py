@@ -0,0 +1,76 @@
+import zlib
+
+from datdecrypt import CHUNK_SIZE
+
+# Decompressors by name. A factory returns a zlib.decompressobj-like object:
+# decompress(data, max_length) -> bytes, plus unconsumed_tail and eof.
+CODECS = {}
+DEFAULT_CODEC = 'zlib'
+
+
+def register_codec(name, factory):
+    CODECS[name] = factory
+
+
+register_codec('zlib', zlib.decompressobj)
+register_codec('deflate', lambda: zlib.decompressobj(-zlib.MAX_WBITS))
+register_codec('gzip', lambda: zlib.decompressobj(zlib.MAX_WBITS | 16))
+
+
+def inflate_into(chunks, out, codec=DEFAULT_CODEC):
+    # Decompresses an iterable of compressed chunks straight into the
+    # preallocated buffer `out`, one input chunk at a time. Returns the number
+    # of bytes written; raises ValueError if the output would not fit.
+    decompressor = CODECS[codec]()
+    view = memoryview(out).cast('B')
+    pos = 0
+    for chunk in chunks:
+        data = chunk
+        while data and not decompressor.eof:
+            space = len(view) - pos
+            # max_length=0 means unlimited, so probe with 1 when out is full.
+            piece = decompressor.decompress(data, space or 1)
+            if len(piece) > space:
+                raise ValueError(f"decompressed data exceeds {len(view)} bytes.")
+            view[pos:pos + len(piece)] = piece
+            pos += len(piece)
+            data = decompressor.unconsumed_tail
+        if decompressor.eof:
+            break
+    if not decompressor.eof:
+        raise ValueError("compressed stream is truncated.")
+    return pos
+
+
+def _chunks(stream, chunk_size):
+    buffer = memoryview(bytearray(chunk_size))
+    while True:
+        n = stream.readinto(buffer)
+        if not n:
+            return
+        yield buffer[:n]
+
+
+def read_entry(archive, name, codec=None, out=None, chunk_size=CHUNK_SIZE):
+    # Decrypt and decompress an entry chunk by chunk into `out` (allocated
+    # from the entry's original size if not given), without ever holding the
+    # whole decrypted-but-compressed payload. codec=None picks DEFAULT_CODEC
+    # for entries whose original size differs from the stored size and plain
+    # copying otherwise.
+    entry = archive.entries[name]
+    if out is None:
+        out = bytearray(entry.original_size)
+    elif memoryview(out).nbytes < entry.original_size:
+        raise ValueError(f"{name}: output buffer of {memoryview(out).nbytes} bytes is smaller than the original size {entry.original_size}.")
+    stream = archive.open(name)
+    if codec is None and entry.original_size == entry.size:
+        view = memoryview(out).cast('B')
+        pos = 0
+        while pos < entry.size:
+            n = stream.readinto(view[pos:entry.size])
+            if not n:
+                break
+            pos += n
+        return out[:pos] if pos < len(out) else out
+    n = inflate_into(_chunks(stream, chunk_size), out, codec or DEFAULT_CODEC)
+    return out[:n] if n < len(out) else out
@@ -1,5 +1,25 @@
+import io
 import struct
-from twfs_tables import MUL_A, DIV_A, S1_T0, S1_T1, S1_T2, S1_T3
+
+import dattables
+
+# MUL_A, DIV_A and S1_T0..S1_T3 are loaded into this module on first use
+# (Cipher() or attribute access), not at import.
+_tables_loaded = False
+
+
+def load_tables():
+    global _tables_loaded
+    globals().update(dattables.load())
+    _tables_loaded = True
+
+
+def __getattr__(name):
+    if name in dattables.TABLE_NAMES:
+        load_tables()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def BYTE0(n):
     return n & 0xFF
@@ -20,6 +40,11 @@ def to_int8(b):
     return b - 256 if b > 127 else b
 
 
+KEYSTREAM_BLOCK = struct.Struct('<16I')
+KEYSTREAM_BLOCK_SIZE = KEYSTREAM_BLOCK.size
+CHUNK_SIZE = 64 * 1024
+
+
 def generate_header_key(combined_string):
     key_buffer = combined_string.encode('ascii')
     key_buffer_size = len(key_buffer)
@@ -56,22 +81,31 @@ def calculate_checksums(filename):
 
     offset1 = (checksum1 % 312) + 30 
     offset2_seed = (checksum2 % 212) + 33
-    
-    print(f"Checksum Offset 1 (for header block): {offset1}")
-    print(f"Checksum Offset 2 (seed for re-keying): {offset2_seed}")
-    
+
     return offset1, offset2_seed, checksum2
 
 
 class Cipher:
 
-    def __init__(self, key):
+    def __init__(self, key, checkpoint_interval=None, checkpoints=None):
         if len(key) != 16:
             raise ValueError("Key must be 16 bytes long.")
+        if checkpoint_interval is not None and (checkpoint_interval <= 0 or checkpoint_interval % KEYSTREAM_BLOCK_SIZE):
+            raise ValueError("Checkpoint interval must be a positive multiple of 64.")
+        if not _tables_loaded:
+            load_tables()
         self.key = key
         self.state = [0] * 256
         self._generate_key_schedule()
         self.keystream_buffer = bytearray()
+        self.position = 0
+        self._blocks = 0
+        self._initial_state = self.state[1:37]
+        # Optional {blocks clocked: state} snapshots taken every
+        # checkpoint_interval bytes, used by seek(). Pass the same dict to
+        # later Ciphers of the same key to reuse them.
+        self._checkpoint_blocks = checkpoint_interval // KEYSTREAM_BLOCK_SIZE if checkpoint_interval else 0
+        self.checkpoints = {} if checkpoints is None else checkpoints
 
     def _load_signed_bigendian(self, key_bytes, offset=0):
         p = key_bytes[offset:]
@@ -334,19 +368,92 @@ class Cipher:
         state[35] = to_uint32(v107 ^ v125 ^ to_uint32(v101 + v103))
 
 
+    def _clock(self):
+        temp_state_slice = self.state[1:37]
+        self.sub_423450(temp_state_slice)
+        self.state[1:37] = temp_state_slice
+        self.state[37] = 0
+        self._blocks += 1
+        if self._checkpoint_blocks and self._blocks % self._checkpoint_blocks == 0:
+            self.checkpoints.setdefault(self._blocks, temp_state_slice)
+
+    def seek(self, offset):
+        # Positions the keystream at byte `offset` from its start by clocking
+        # whole blocks from the closest usable state (the current one, a
+        # checkpoint or the key schedule) without producing any output.
+        blocks, byte = divmod(offset, KEYSTREAM_BLOCK_SIZE)
+        if byte:
+            blocks += 1
+        start, state = 0, self._initial_state
+        if self._checkpoint_blocks:
+            candidate = blocks - blocks % self._checkpoint_blocks
+            while candidate > 0 and candidate not in self.checkpoints:
+                candidate -= self._checkpoint_blocks
+            if candidate > 0:
+                start, state = candidate, self.checkpoints[candidate]
+        if start <= self._blocks <= blocks:
+            start, state = self._blocks, None
+        if state is not None:
+            self.state[1:37] = state
+            self._blocks = start
+        while self._blocks < blocks:
+            self._clock()
+        self.keystream_buffer = bytearray()
+        word, rem = divmod(byte, 4)
+        if not byte:
+            self.state[37] = 16
+        elif rem:
+            self.keystream_buffer.extend(struct.pack('<I', self.state[21 + word])[rem:])
+            self.state[37] = word + 1
+        else:
+            self.state[37] = word
+        self.position = offset
+
     def _ensure_keystream(self, length):
         while len(self.keystream_buffer) < length:
             counter = self.state[37]
             if counter == 16:
-                temp_state_slice = self.state[1:37]
-                self.sub_423450(temp_state_slice)
-                self.state[1:37] = temp_state_slice
-                self.state[37] = 0
+                self._clock()
                 counter = 0
             keystream_word = self.state[counter + 21]
             self.state[37] = counter + 1
             self.keystream_buffer.extend(struct.pack('<I', keystream_word))
 
+    def keystream_into(self, buffer, length):
+        # Writes the next `length` keystream bytes into `buffer`, consuming them
+        # exactly like _ensure_keystream + stream_decrypt would, but a whole
+        # 64-byte block per sub_423450 call instead of one word at a time.
+        out = memoryview(buffer).cast('B')
+        pos = 0
+        if self.keystream_buffer:
+            pos = min(len(self.keystream_buffer), length)
+            out[:pos] = self.keystream_buffer[:pos]
+            del self.keystream_buffer[:pos]
+        counter = self.state[37]
+        while pos < length:
+            if counter == 16:
+                self._clock()
+                counter = 0
+            if counter == 0 and length - pos >= KEYSTREAM_BLOCK_SIZE:
+                KEYSTREAM_BLOCK.pack_into(out, pos, *self.state[21:37])
+                pos += KEYSTREAM_BLOCK_SIZE
+                counter = 16
+                continue
+            words = min(16 - counter, (length - pos) >> 2)
+            if words:
+                struct.pack_into('<%dI' % words, out, pos, *self.state[21 + counter:21 + counter + words])
+                pos += words * 4
+                counter += words
+                continue
+            # Tail shorter than a word: the rest of it stays buffered.
+            tail = struct.pack('<I', self.state[21 + counter])
+            counter += 1
+            out[pos:length] = tail[:length - pos]
+            self.keystream_buffer.extend(tail[length - pos:])
+            pos = length
+        self.state[37] = counter
+        self.position += length
+
     def stream_decrypt(self, input_bytes, length):
         if length == 0:
             return bytearray()
@@ -357,6 +464,7 @@ class Cipher:
         keystream_data = self.keystream_buffer[:length]
 
         self.keystream_buffer = self.keystream_buffer[length:]
+        self.position += length
 
         input_int = int.from_bytes(input_data, 'little')
         keystream_int = int.from_bytes(keystream_data, 'little')
@@ -365,110 +473,166 @@ class Cipher:
         output_int = (input_int - keystream_int) & mask
 
         return bytearray(output_int.to_bytes(length, 'little'))
-if __name__ == '__main__':
-    filename = "dt_00028.dat"
-    base_key = "VS#sg#^$sa2d34"
-    offset1, offset2_seed, raw_checksum2 = calculate_checksums(filename)
-    
-    combined_string = filename + base_key
-    header_key = generate_header_key(combined_string)
-    print(f"Header key: {header_key.hex()}")
-
-    try:
-        with open(filename, 'rb') as f:
-            file_content = f.read()
-    except FileNotFoundError:
-        print(f"Error: The file '{filename}' was not found.")
-        exit()
-
-    print("\n--- Header Check ---")
-    header_cipher = Cipher(header_key)
-    
-    enc_dword1_bytes = file_content[offset1 : offset1 + 4]
-    offset1 += 4
-    enc_byte = file_content[offset1 : offset1 + 1]
-    offset1 += 1
-    enc_dword2_bytes = file_content[offset1 : offset1 + 4]
-    offset1 += 4
-    decrypted_dword1_bytes =header_cipher.stream_decrypt(enc_dword1_bytes, 4)
-    decrypted_byte = header_cipher.stream_decrypt(enc_byte, 1)[0]
-    decrypted_dword2_bytes = header_cipher.stream_decrypt(enc_dword2_bytes, 4)
-    print(f"decrypted dword2_bytes: {decrypted_dword2_bytes.hex()}")
-
-    decrypted_dword1 = struct.unpack_from('<I', decrypted_dword1_bytes, 0)[0]
-    decrypted_dword2 = struct.unpack_from('<I', decrypted_dword2_bytes, 0)[0]
-    
-    print(f"Decrypted: dword1={decrypted_dword1}, version={decrypted_byte}, dword2={decrypted_dword2}")
-    
-    if decrypted_dword1 != to_uint32(decrypted_dword2 + decrypted_byte):
-        print("\nError: Header integrity failed.")
-        exit()
-    print("Header OK.")
-    print("\n--- Parsing file metadata ---")
-    num_chunks = decrypted_dword2
-    metadata_start_offset = offset1 + offset2_seed
-    
-    print(f"\nDAT file contains {num_chunks} files.")
-    
-    content_key_seed = (offset1-9) + offset2_seed
 
-    
-    content_sbox = generate_content_sbox(combined_string, content_key_seed)
-    content_key = content_sbox[:16]
-    print(f"Content key: {content_key.hex()}")
-    content_cipher = Cipher(content_key)
-    cunknum = 0
-    while cunknum < num_chunks:
-        enc_entry_size = file_content[metadata_start_offset : metadata_start_offset + 4]
-        namelen = content_cipher.stream_decrypt(enc_entry_size, 4)
-        namelen = struct.unpack_from('<I', namelen, 0)[0]*2
-
-        metadata_start_offset += 4
-
-        enc_filename = file_content[metadata_start_offset : metadata_start_offset + namelen]
-        dec_filename = content_cipher.stream_decrypt(enc_filename, namelen)
-        print(f"Filename: {dec_filename.decode('utf-8')}")
-        metadata_start_offset += namelen
-
-
-        #unk1 (4 bytes)
-        enc_unk1 = file_content[metadata_start_offset : metadata_start_offset + 4]
-        dec_unk1 = content_cipher.stream_decrypt(enc_unk1, 4)
-        unk1 = struct.unpack_from('<I', dec_unk1, 0)[0]
-        print(f"unk1: 0x{unk1:08x}")
-        metadata_start_offset += 4
-
-        #cryptflag (4 bytes)
-        enc_cryptflag = file_content[metadata_start_offset : metadata_start_offset + 4]
-        dec_cryptflag = content_cipher.stream_decrypt(enc_cryptflag, 4)
-        cryptflag = struct.unpack_from('<I', dec_cryptflag, 0)[0]
-        print(f"cryptflag: 0x{cryptflag:08x}")
-        metadata_start_offset += 4
-
-        #unk2 (4 bytes)
-        enc_unk2 = file_content[metadata_start_offset : metadata_start_offset + 4]
-        dec_unk2 = content_cipher.stream_decrypt(enc_unk2, 4)
-        unk2 = struct.unpack_from('<I', dec_unk2, 0)[0]
-        print(f"unk2: 0x{unk2:08x}")
-        metadata_start_offset += 4
-
-        #unk3 (4 bytes)
-        enc_unk3 = file_content[metadata_start_offset : metadata_start_offset + 4]
-        dec_unk3 = content_cipher.stream_decrypt(enc_unk3, 4)
-        unk3 = struct.unpack_from('<I', dec_unk3, 0)[0]
-        print(f"unk3: 0x{unk3:08x}")
-        metadata_start_offset += 4
-
-        #unk4 (4 bytes)
-        enc_unk4 = file_content[metadata_start_offset : metadata_start_offset + 4]
-        dec_unk4 = content_cipher.stream_decrypt(enc_unk4, 4)
-        unk4 = struct.unpack_from('<I', dec_unk4, 0)[0]
-        print(f"unk4: 0x{unk4:08x}")
-        metadata_start_offset += 4
-
-        #filekey (16 bytes)
-        enc_filekey = file_content[metadata_start_offset : metadata_start_offset + 16]
-        filekey = content_cipher.stream_decrypt(enc_filekey, 16)
-        print(f"filekey: {filekey.hex()}")
-        metadata_start_offset += 16
-        cunknum += 1
\ No newline at end of file
+    def stream_encrypt(self, input_bytes, length):
+        # Inverse of stream_decrypt: adds the keystream instead of subtracting it.
+        if length == 0:
+            return bytearray()
+        keystream = bytearray(length)
+        self.keystream_into(keystream, length)
+        mask = (1 << (length * 8)) - 1
+        output_int = (int.from_bytes(input_bytes[:length], 'little') + int.from_bytes(keystream, 'little')) & mask
+        return bytearray(output_int.to_bytes(length, 'little'))
+
+class StreamDecryptor(io.RawIOBase):
+    """File-like equivalent of ``cipher.stream_decrypt(data, length)`` over a
+    single run of ``length`` bytes, decrypted chunk by chunk.
+
+    ``source`` is either a binary file object or any bytes-like object (a
+    memoryview over an mmap works). The subtraction borrow is carried between
+    chunks, so the concatenated output matches one big stream_decrypt call.
+
+    The stream is seekable when the source is: seek() moves the cipher with
+    Cipher.seek and recovers the borrow into the new position, scanning back
+    to the nearest byte where ciphertext and keystream differ when the
+    cipher has checkpoints, else forward from the current position.
+    """
+
+    def __init__(self, cipher, source, length):
+        self.cipher = cipher
+        self._origin = cipher.position
+        self.length = length
+        self.pos = 0
+        self._borrow = 0
+        self._keystream = bytearray(CHUNK_SIZE)
+        if hasattr(source, 'readinto'):
+            self._file = source
+            self._view = None
+            self._base = source.tell() if getattr(source, 'seekable', lambda: False)() else None
+        else:
+            self._file = None
+            self._view = memoryview(source).cast('B')
+
+    @property
+    def remaining(self):
+        return self.length - self.pos
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self._view is not None or self._base is not None
+
+    def tell(self):
+        return self.pos
+
+    def _read_at(self, offset, length):
+        if self._view is not None:
+            return self._view[offset:offset + length]
+        self._file.seek(self._base + offset)
+        return self._file.read(length)
+
+    def _borrow_into(self, offset):
+        # With checkpoints, seeking is cheap: scan back from `offset` to the
+        # closest lower byte where ciphertext != keystream (in practice one
+        # or two bytes). Without them every seek backwards clocks from the
+        # start of the entry, so run the subtraction forward once instead,
+        # from the current position or from the start.
+        if self.cipher._checkpoint_blocks and offset < self.pos:
+            return self._borrow_back(offset)
+        if offset < self.pos:
+            self.cipher.seek(self._origin)
+            pos, borrow = 0, False
+        else:
+            pos, borrow = self.pos, self._borrow
+        while pos < offset:
+            n = min(offset - pos, len(self._keystream))
+            data = self._read_at(pos, n)
+            if len(data) < n:
+                break
+            keystream = memoryview(self._keystream)[:n]
+            self.cipher.keystream_into(keystream, n)
+            borrow = int.from_bytes(data, 'little') - int.from_bytes(keystream, 'little') - borrow < 0
+            pos += n
+        return borrow
+
+    def _borrow_back(self, offset):
+        end = offset
+        window = KEYSTREAM_BLOCK_SIZE
+        while end > 0:
+            start = max(0, end - window)
+            data = self._read_at(start, end - start)
+            keystream = bytearray(len(data))
+            self.cipher.seek(self._origin + start)
+            self.cipher.keystream_into(keystream, len(data))
+            for i in range(len(data) - 1, -1, -1):
+                if data[i] != keystream[i]:
+                    return data[i] < keystream[i]
+            end = start
+            window *= 2
+        return False
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if not self.seekable():
+            raise io.UnsupportedOperation("source is not seekable")
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.length
+        offset = max(0, min(offset, self.length))
+        self._borrow = self._borrow_into(offset)
+        self.cipher.seek(self._origin + offset)
+        if self._file is not None:
+            self._file.seek(self._base + offset)
+        self.pos = offset
+        return offset
+
+    def _fill(self, out):
+        if self._view is not None:
+            n = min(len(out), len(self._view) - self.pos)
+            out[:n] = self._view[self.pos:self.pos + n]
+            return n
+        pos = 0
+        while pos < len(out):
+            got = self._file.readinto(out[pos:])
+            if not got:
+                break
+            pos += got
+        return pos
+
+    def readinto(self, b):
+        out = memoryview(b).cast('B')
+        want = min(len(out), self.remaining)
+        if want <= 0:
+            return 0
+        n = self._fill(out[:want])
+        if n == 0:
+            # Source ended early.
+            self.length = self.pos
+            return 0
+        self.pos += n
+        if n > len(self._keystream):
+            self._keystream = bytearray(n)
+        keystream = memoryview(self._keystream)[:n]
+        self.cipher.keystream_into(keystream, n)
+        value = int.from_bytes(out[:n], 'little') - int.from_bytes(keystream, 'little') - self._borrow
+        self._borrow = value < 0
+        if self._borrow:
+            value += 1 << (n * 8)
+        out[:n] = value.to_bytes(n, 'little')
+        return n
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        # The yielded views share one buffer and are only valid until the next step.
+        buffer = memoryview(bytearray(chunk_size))
+        while True:
+            n = self.readinto(buffer)
+            if not n:
+                return
+            yield buffer[:n]
+
+
+if __name__ == '__main__':
+    import sys
+    from datarchive import main
+    main(sys.argv[1:] or ["dt_00028.dat"])
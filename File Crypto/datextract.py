@@ -0,0 +1,109 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from datarchive import Archive
+
+# Entries smaller than this are grouped into one task so that IPC overhead
+# does not dominate; larger ones are scheduled on their own.
+BATCH_BYTES = 4 * 1024 * 1024
+
+_archives = {}
+
+
+def _open_archive(path, cache):
+    # One Archive per worker process; thanks to the metadata cache reopening
+    # it in a worker is just a map of the file and the index.
+    archive = _archives.get(path)
+    if archive is None:
+        archive = _archives[path] = Archive(path, cache=cache)
+    return archive
+
+
+def entry_path(out_dir, archive_name, entry_name):
+    parts = [part for part in entry_name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    return os.path.join(out_dir, os.path.splitext(archive_name)[0], *parts)
+
+
+def extract_entry(archive, row, dest):
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open(dest, 'wb') as out:
+        return archive.extract(row, out)
+
+
+def _extract_task(jobs, out_dir, cache):
+    written = 0
+    for path, row in jobs:
+        archive = _open_archive(path, cache)
+        written += extract_entry(archive, row, entry_path(out_dir, archive.name, archive.entries.name(row)))
+    return len(jobs), written
+
+
+def plan(paths, cache=True, batch_bytes=BATCH_BYTES, rows=None):
+    # Largest entries first (longest processing time first), small entries
+    # packed together, across all archives at once. `rows` optionally limits
+    # each archive path to the given row numbers.
+    jobs = []
+    for path in paths:
+        with Archive(path, cache=cache) as archive:
+            sizes = archive.entries.sizes
+            selected = range(len(archive)) if rows is None else rows.get(path, ())
+            jobs.extend((sizes[row], path, row) for row in selected)
+    jobs.sort(reverse=True)
+    tasks, batch, batch_size = [], [], 0
+    for size, path, row in jobs:
+        if size >= batch_bytes:
+            tasks.append(([(path, row)], size))
+            continue
+        batch.append((path, row))
+        batch_size += size
+        if batch_size >= batch_bytes:
+            tasks.append((batch, batch_size))
+            batch, batch_size = [], 0
+    if batch:
+        tasks.append((batch, batch_size))
+    return tasks
+
+
+def extract_all(paths, out_dir, workers=None, cache=True, progress=None, rows=None):
+    tasks = plan(paths, cache, rows=rows)
+    total_files = sum(len(jobs) for jobs, _ in tasks)
+    total_bytes = sum(size for _, size in tasks)
+    done_files = done_bytes = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_extract_task, jobs, out_dir, cache) for jobs, _ in tasks]
+        for future in as_completed(futures):
+            files, written = future.result()
+            done_files += files
+            done_bytes += written
+            if progress is not None:
+                progress(done_files, total_files, done_bytes, total_bytes, time.perf_counter() - start)
+    return done_files, done_bytes, time.perf_counter() - start
+
+
+def print_progress(done_files, total_files, done_bytes, total_bytes, elapsed):
+    rate = done_bytes / elapsed / 1e6 if elapsed else 0.0
+    print(f"\r{done_files}/{total_files} files, {done_bytes / 1e6:.1f}/{total_bytes / 1e6:.1f} MB, {rate:.1f} MB/s", end='', file=sys.stderr)
+
+
+def dat_files(data_dir):
+    return sorted(os.path.join(data_dir, name) for name in os.listdir(data_dir) if name.lower().endswith('.dat'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract every .dat archive in a DATA folder.")
+    parser.add_argument('data_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--cache-dir', default=None, help="where to keep metadata indexes (default: next to each archive)")
+    args = parser.parse_args(argv)
+    cache = args.cache_dir or True
+    files, written, elapsed = extract_all(dat_files(args.data_dir), args.out_dir, args.jobs, cache, print_progress)
+    print(f"\nExtracted {files} files, {written / 1e6:.1f} MB in {elapsed:.1f}s.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
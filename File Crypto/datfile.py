@@ -0,0 +1,20 @@
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def replace_atomically(path, mode='wb'):
+    # Yields a temporary file next to `path` that replaces it once the block
+    # completes; on any error the temporary file is removed and `path` is
+    # left as it was.
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,156 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from datarchive import Archive
+from datextract import dat_files, entry_path, extract_all, print_progress
+from datfile import replace_atomically
+
+FORMAT = 1
+# Fields that identify an entry's content; unk1 (the payload offset) is left
+# out since it shifts whenever an earlier entry changes size.
+CONTENT_FIELDS = ('cryptflag', 'unk2', 'unk3', 'unk4', 'filekey', 'size', 'hash')
+
+
+def payload_hash(payload):
+    # Hash of the payload as stored (still encrypted), so nothing is decrypted.
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def archive_manifest(path, cache=True):
+    st = os.stat(path)
+    entries = {}
+    with Archive(path, cache=cache) as archive:
+        for entry in archive:
+            entries[entry.name] = {
+                'unk1': entry.unk1, 'cryptflag': entry.cryptflag, 'unk2': entry.unk2, 'unk3': entry.unk3, 'unk4': entry.unk4,
+                'filekey': entry.filekey.hex(), 'size': entry.size, 'hash': payload_hash(archive.payload(entry.name)),
+            }
+        version = archive.version
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'version': version, 'entries': entries}
+
+
+def _unchanged_file(path, record):
+    st = os.stat(path)
+    return record is not None and record['size'] == st.st_size and record['mtime_ns'] == st.st_mtime_ns
+
+
+def build(paths, workers=None, cache=True, previous=None):
+    """Manifest of the given archives, keyed by archive file name.
+
+    With a ``previous`` manifest, archives whose size and mtime did not
+    change keep their old record instead of being hashed again.
+    """
+    previous = (previous or {}).get('archives', {})
+    archives = {}
+    todo = []
+    for path in paths:
+        name = os.path.basename(path)
+        if _unchanged_file(path, previous.get(name)):
+            archives[name] = previous[name]
+        else:
+            todo.append(path)
+    if workers == 0 or len(todo) < 2:
+        records = [archive_manifest(path, cache) for path in todo]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            records = list(pool.map(archive_manifest, todo, [cache] * len(todo)))
+    for path, record in zip(todo, records):
+        archives[os.path.basename(path)] = record
+    return {'format': FORMAT, 'archives': dict(sorted(archives.items()))}
+
+
+def load(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != FORMAT:
+        raise ValueError(f"{path}: unsupported manifest format {manifest.get('format')!r}.")
+    return manifest
+
+
+def save(manifest, path):
+    with replace_atomically(path, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+
+
+def diff(old, new):
+    # {'added'|'changed'|'removed': [(archive name, entry name), ...]}
+    changes = {'added': [], 'changed': [], 'removed': []}
+    old_archives, new_archives = old.get('archives', {}), new.get('archives', {})
+    for archive_name in sorted(set(old_archives) | set(new_archives)):
+        before = old_archives.get(archive_name, {}).get('entries', {})
+        after = new_archives.get(archive_name, {}).get('entries', {})
+        for name, record in after.items():
+            if name not in before:
+                changes['added'].append((archive_name, name))
+            elif any(before[name][field] != record[field] for field in CONTENT_FIELDS):
+                changes['changed'].append((archive_name, name))
+        changes['removed'].extend((archive_name, name) for name in before if name not in after)
+    return changes
+
+
+def extract_changes(changes, data_dir, out_dir, workers=None, cache=True, progress=None, prune=False):
+    """Extracts the added and changed entries of a diff from data_dir.
+
+    With prune, files of removed entries are deleted from out_dir.
+    """
+    wanted = {}
+    for archive_name, name in changes['added'] + changes['changed']:
+        wanted.setdefault(os.path.join(data_dir, archive_name), []).append(name)
+    rows = {}
+    for path, names in wanted.items():
+        with Archive(path, cache=cache) as archive:
+            rows[path] = [archive.entries.index(name) for name in names]
+    result = extract_all(list(rows), out_dir, workers, cache, progress, rows=rows) if rows else (0, 0, 0.0)
+    if prune:
+        for archive_name, name in changes['removed']:
+            try:
+                os.remove(entry_path(out_dir, archive_name, name))
+            except FileNotFoundError:
+                pass
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manifests of DATA folders, and incremental extraction from their differences.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_cmd = commands.add_parser('build', help="write the manifest of a DATA folder")
+    build_cmd.add_argument('data_dir')
+    build_cmd.add_argument('manifest')
+    diff_cmd = commands.add_parser('diff', help="list added, changed and removed entries between two manifests")
+    diff_cmd.add_argument('old')
+    diff_cmd.add_argument('new')
+    update_cmd = commands.add_parser('update', help="extract what changed since a manifest, then update it")
+    update_cmd.add_argument('manifest', help="manifest of the last extraction (missing: extract everything)")
+    update_cmd.add_argument('data_dir')
+    update_cmd.add_argument('out_dir')
+    update_cmd.add_argument('--prune', action='store_true', help="delete extracted files of removed entries")
+    for cmd in (build_cmd, update_cmd):
+        cmd.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: CPU count)")
+        cmd.add_argument('--cache-dir', default=None, help="where to keep metadata indexes (default: next to each archive)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'diff':
+        changes = diff(load(args.old), load(args.new))
+        for kind, sign in (('added', '+'), ('changed', '*'), ('removed', '-')):
+            for archive_name, name in changes[kind]:
+                print(f"{sign} {archive_name} {name}")
+        return
+    cache = args.cache_dir or True
+    if args.command == 'build':
+        save(build(dat_files(args.data_dir), args.jobs, cache), args.manifest)
+        return
+    old = load(args.manifest) if os.path.exists(args.manifest) else {}
+    new = build(dat_files(args.data_dir), args.jobs, cache, previous=old)
+    changes = diff(old, new)
+    files, written, elapsed = extract_changes(changes, args.data_dir, args.out_dir, args.jobs, cache, print_progress, args.prune)
+    save(new, args.manifest)
+    print(f"\n{len(changes['added'])} added, {len(changes['changed'])} changed, {len(changes['removed'])} removed; "
+          f"extracted {files} files, {written / 1e6:.1f} MB in {elapsed:.1f}s.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
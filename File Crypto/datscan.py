@@ -0,0 +1,178 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from datarchive import BASE_KEY, COLUMNS, HEADER_SIZE, MIN_RECORD_SIZE, OFFSET_FIELD, SIZE_FIELD, MetadataDecoder
+from datdecrypt import Cipher, calculate_checksums, generate_content_sbox, generate_header_key, to_uint32
+
+# Longer names are treated as a corrupt length field.
+MAX_NAME_CHARS = 1024
+# Errors listed per archive; the rest are only counted.
+MAX_ERRORS = 20
+
+
+def _header(view, name, base_key):
+    # (version, entry count, metadata offset, content key) or an error string.
+    combined_string = name + base_key
+    offset1, offset2_seed, _ = calculate_checksums(name)
+    metadata_offset = offset1 + HEADER_SIZE + offset2_seed
+    if len(view) < metadata_offset:
+        return f"file is {len(view)} bytes, header needs {metadata_offset}."
+    header_cipher = Cipher(generate_header_key(combined_string))
+    dword1 = struct.unpack('<I', header_cipher.stream_decrypt(view[offset1:offset1 + 4], 4))[0]
+    version = header_cipher.stream_decrypt(view[offset1 + 4:offset1 + 5], 1)[0]
+    dword2 = struct.unpack('<I', header_cipher.stream_decrypt(view[offset1 + 5:offset1 + 9], 4))[0]
+    if dword1 != to_uint32(dword2 + version):
+        return "header integrity failed."
+    return version, dword2, metadata_offset, generate_content_sbox(combined_string, offset1 + offset2_seed)[:16]
+
+
+def scan_view(view, name, base_key=BASE_KEY):
+    """Checks the header and metadata table of one archive.
+
+    Only the header and the metadata bytes are read; payloads are checked
+    against the file bounds and each other but never decrypted.
+    """
+    report = {'archive': name, 'size': len(view), 'ok': False, 'errors': [], 'error_count': 0}
+
+    def error(message):
+        report['error_count'] += 1
+        if len(report['errors']) < MAX_ERRORS:
+            report['errors'].append(message)
+
+    header = _header(view, name, base_key)
+    if isinstance(header, str):
+        error(header)
+        return report
+    version, count, metadata_offset, content_key = header
+    report.update(version=version, entries=count)
+    if count * MIN_RECORD_SIZE > len(view) - metadata_offset:
+        error(f"{count} entries cannot fit in the {len(view) - metadata_offset} bytes after the header.")
+        return report
+
+    decoder = MetadataDecoder(Cipher(content_key), view, metadata_offset, count)
+    ranges = []
+    for row in range(count):
+        try:
+            namelen = decoder.word()
+            if namelen > MAX_NAME_CHARS:
+                error(f"entry {row}: name length {namelen} at {decoder.offset - 4}.")
+                return report
+            raw_name = decoder.block(namelen * 2) if namelen else b''
+            words = dict(zip(COLUMNS, decoder.words()))
+            offset, size = words[OFFSET_FIELD], words[SIZE_FIELD]
+            decoder.block(16)
+        except ValueError as e:
+            error(f"entry {row}: {e}")
+            return report
+        try:
+            entry_name = raw_name.decode('utf-16-le')
+        except UnicodeDecodeError:
+            entry_name = f"#{row}"
+            error(f"entry {row}: name is not valid UTF-16.")
+        if offset + size > len(view):
+            error(f"{entry_name}: payload {offset}+{size} runs past end of file.")
+        ranges.append((offset, size, entry_name))
+    metadata_end = decoder.offset
+    report['metadata_end'] = metadata_end
+
+    ranges.sort()
+    previous_end, previous_name = metadata_end, None
+    for offset, size, entry_name in ranges:
+        if offset < metadata_end:
+            error(f"{entry_name}: payload at {offset} starts inside the header or metadata.")
+        elif size and offset < previous_end and previous_name is not None:
+            error(f"{entry_name}: payload at {offset} overlaps {previous_name}.")
+        if size and offset + size > previous_end:
+            previous_end, previous_name = offset + size, entry_name
+    report['payload_bytes'] = sum(size for _, size, _ in ranges)
+    report['ok'] = report['error_count'] == 0
+    return report
+
+
+def scan(path, base_key=BASE_KEY):
+    start = time.perf_counter()
+    name = os.path.basename(path)
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                report = {'archive': name, 'size': 0, 'ok': False, 'errors': ["empty file."], 'error_count': 1}
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        report = scan_view(view, name, base_key)
+                    finally:
+                        view.release()
+    except OSError as e:
+        report = {'archive': name, 'ok': False, 'errors': [str(e)], 'error_count': 1}
+    report['path'] = path
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+
+def find_archives(paths):
+    # .dat files given directly or found under the given directories (at any
+    # depth, so one call can cover several install images).
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                found.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith('.dat'))
+        else:
+            found.append(path)
+    return found
+
+
+def scan_all(paths, workers=None, base_key=BASE_KEY):
+    start = time.perf_counter()
+    archives, empty = [], []
+    for path in paths:
+        found = find_archives([path])
+        if not found:
+            empty.append(path)
+        archives.extend(found)
+    if workers == 0:
+        reports = [scan(path, base_key) for path in archives]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            reports = list(pool.map(scan, archives, [base_key] * len(archives), chunksize=max(1, len(archives) // 256)))
+    return {
+        'scanned': len(reports),
+        'failed': sum(not report['ok'] for report in reports),
+        'empty': empty,
+        'seconds': time.perf_counter() - start,
+        'archives': reports,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the headers and metadata tables of .dat archives without extracting anything.")
+    parser.add_argument('paths', nargs='+', help=".dat files or directories to search")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (0: none, default: CPU count)")
+    parser.add_argument('-o', '--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--failed-only', action='store_true', help="only list archives with errors")
+    args = parser.parse_args(argv)
+    report = scan_all(args.paths, args.jobs)
+    if args.failed_only:
+        report['archives'] = [archive for archive in report['archives'] if not archive['ok']]
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    for path in report['empty']:
+        print(f"error: no .dat files found in {path}.", file=sys.stderr)
+    print(f"{report['scanned']} archives scanned, {report['failed']} failed, {report['seconds']:.2f}s.", file=sys.stderr)
+    return 1 if report['failed'] or report['empty'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import array
+import os
+import struct
+import sys
+
+from datfile import replace_atomically
+
+# The cipher tables as one binary blob: a header, then each table as 256
+# little-endian uint32. Reading it is a single 6 KB read instead of
+# compiling twfs_tables.py; the blob is only written by build().
+TABLE_NAMES = ('MUL_A', 'DIV_A', 'S1_T0', 'S1_T1', 'S1_T2', 'S1_T3')
+TABLE_SIZE = 256
+BLOB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'twfs_tables.bin')
+MAGIC = b'TWTB'
+FORMAT = 1
+HEADER = struct.Struct('<4sHH')
+
+
+def from_source():
+    # The tables straight from twfs_tables.py.
+    import twfs_tables
+
+    tables = {}
+    for name in TABLE_NAMES:
+        values = list(getattr(twfs_tables, name))
+        if len(values) != TABLE_SIZE:
+            raise ValueError(f"{name} has {len(values)} entries, expected {TABLE_SIZE}.")
+        tables[name] = values
+    return tables
+
+
+def build(path=BLOB_PATH):
+    # Writes the blob from twfs_tables.py and returns the tables. Only run
+    # explicitly (python dattables.py), and again whenever the tables change.
+    tables = from_source()
+    data = bytearray(HEADER.pack(MAGIC, FORMAT, len(TABLE_NAMES)))
+    for name in TABLE_NAMES:
+        data += struct.pack(f'<{TABLE_SIZE}I', *tables[name])
+    with replace_atomically(path) as f:
+        f.write(data)
+    return tables
+
+
+def read(path=BLOB_PATH, lists=True):
+    # lists=False keeps each table as one array('I') buffer: slower to index
+    # from Python, but its pages stay shared with forked workers and numpy
+    # can use it without a copy.
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT or count != len(TABLE_NAMES) or len(data) != HEADER.size + count * TABLE_SIZE * 4:
+        raise ValueError(f"{path} is not a table blob of format {FORMAT}.")
+    tables = {}
+    pos = HEADER.size
+    for name in TABLE_NAMES:
+        table = array.array('I')
+        table.frombytes(data[pos:pos + TABLE_SIZE * 4])
+        if sys.byteorder == 'big':
+            table.byteswap()
+        # Lists by default: indexing a list is what the cipher rounds are
+        # fastest with.
+        tables[name] = table.tolist() if lists else table
+        pos += TABLE_SIZE * 4
+    return tables
+
+
+def load(path=BLOB_PATH, lists=True):
+    # The tables from the blob if it has been built, else from
+    # twfs_tables.py. Nothing is written.
+    try:
+        return read(path, lists)
+    except (OSError, ValueError, struct.error):
+        tables = from_source()
+    if not lists:
+        tables = {name: array.array('I', values) for name, values in tables.items()}
+    return tables
+
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else BLOB_PATH)
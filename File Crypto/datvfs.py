@@ -0,0 +1,226 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+from datarchive import Archive, PayloadReader
+from datextract import dat_files
+
+SEP = '/'
+CACHE_BYTES = 256 * 1024 * 1024
+
+Stat = namedtuple('Stat', 'path is_dir size original_size encrypted archive')
+
+
+def split(path):
+    return tuple(part for part in path.replace('\\', SEP).split(SEP) if part not in ('', '.'))
+
+
+class _Flight:
+    # One decryption in progress that other readers wait for.
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+
+
+class _Mount:
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = None
+        self.files = None
+        self.dirs = None
+
+
+class DataFS:
+    """Read-only file system over every .dat archive of a DATA folder.
+
+    Paths look like ``<archive stem>/<entry path>`` (the layout datextract
+    writes). An archive is opened and indexed the first time a path inside
+    it is used. Decrypted entries are kept in an LRU cache bounded by
+    ``cache_bytes``; concurrent reads of an entry that is not cached yet
+    share a single decryption. ``archive_cache`` is passed on to Archive.
+    """
+
+    def __init__(self, data_dir, cache_bytes=CACHE_BYTES, archive_cache=None):
+        self.data_dir = data_dir
+        self.cache_bytes = cache_bytes
+        self.archive_cache = archive_cache
+        self._mounts = {os.path.splitext(os.path.basename(path))[0]: _Mount(path) for path in dat_files(data_dir)}
+        self._lock = threading.Lock()
+        self._mount_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._mount_lock:
+            for mount in self._mounts.values():
+                if mount.archive is not None:
+                    mount.archive.close()
+                    mount.archive = None
+        with self._lock:
+            self._cache.clear()
+            self.cached_bytes = 0
+
+    def _mount(self, stem):
+        mount = self._mounts.get(stem)
+        if mount is None:
+            raise FileNotFoundError(stem)
+        if mount.archive is None:
+            with self._mount_lock:
+                if mount.archive is None:
+                    archive = Archive(mount.path, cache=self.archive_cache)
+                    files, dirs = {}, {(): set()}
+                    for row in range(len(archive.entries)):
+                        parts = split(archive.entries.name(row))
+                        if not parts:
+                            continue
+                        files[parts] = row
+                        for depth in range(len(parts)):
+                            dirs.setdefault(parts[:depth], set()).add(parts[depth])
+                    mount.files, mount.dirs = files, dirs
+                    mount.archive = archive
+        return mount
+
+    def _resolve(self, path):
+        # (mount, parts inside the archive) or (None, ()) for the root.
+        parts = split(path)
+        if not parts:
+            return None, ()
+        return self._mount(parts[0]), parts[1:]
+
+    def listdir(self, path=''):
+        mount, parts = self._resolve(path)
+        if mount is None:
+            return sorted(self._mounts)
+        if parts not in mount.dirs:
+            if parts in mount.files:
+                raise NotADirectoryError(path)
+            raise FileNotFoundError(path)
+        return sorted(mount.dirs[parts])
+
+    def stat(self, path):
+        mount, parts = self._resolve(path)
+        if mount is None or parts in mount.dirs:
+            return Stat(path, True, 0, 0, False, mount and os.path.basename(mount.path))
+        row = mount.files.get(parts)
+        if row is None:
+            raise FileNotFoundError(path)
+        entry = mount.archive.entries[row]
+        return Stat(path, False, entry.size, entry.original_size, entry.encrypted, os.path.basename(mount.path))
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def isdir(self, path):
+        try:
+            return self.stat(path).is_dir
+        except FileNotFoundError:
+            return False
+
+    def _decrypt(self, archive, row):
+        size = archive.entries[row].size
+        data = bytearray(size)
+        view = memoryview(data)
+        stream = archive.open(row)
+        pos = 0
+        while pos < size:
+            n = stream.readinto(view[pos:])
+            if not n:
+                raise ValueError(f"{archive.name}: entry {row} is truncated.")
+            pos += n
+        return data
+
+    def _store(self, key, data):
+        # Called with the lock held.
+        if len(data) > self.cache_bytes:
+            return
+        self._cache[key] = data
+        self.cached_bytes += len(data)
+        while self.cached_bytes > self.cache_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+            self.evictions += 1
+
+    def read(self, path):
+        """Decrypted contents of a file, as a read-only memoryview.
+
+        The view shares the cached buffer, so it stays valid (and correct)
+        after the entry is evicted.
+        """
+        mount, parts = self._resolve(path)
+        row = mount.files.get(parts) if mount is not None else None
+        if row is None:
+            if mount is None or parts in mount.dirs:
+                raise IsADirectoryError(path)
+            raise FileNotFoundError(path)
+        key = (mount.path, row)
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return memoryview(data).toreadonly()
+            flight = self._inflight.get(key)
+            if flight is None:
+                flight = self._inflight[key] = _Flight()
+                leader = True
+                self.misses += 1
+            else:
+                leader = False
+                self.shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return memoryview(flight.data).toreadonly()
+        try:
+            flight.data = self._decrypt(mount.archive, row)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if flight.error is None:
+                    self._store(key, flight.data)
+            flight.done.set()
+        return memoryview(flight.data).toreadonly()
+
+    def open(self, path):
+        # Seekable binary stream over read(path).
+        return PayloadReader(self.read(path))
+
+    def walk(self, path=''):
+        # Like os.walk, top-down.
+        dirs, files = [], []
+        for name in self.listdir(path):
+            child = f"{path}{SEP}{name}" if path else name
+            (dirs if self.isdir(child) else files).append(name)
+        yield path, dirs, files
+        for name in dirs:
+            yield from self.walk(f"{path}{SEP}{name}" if path else name)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits, 'misses': self.misses, 'shared': self.shared, 'evictions': self.evictions,
+                'entries': len(self._cache), 'bytes': self.cached_bytes, 'budget': self.cache_bytes,
+                'mounted': sum(mount.archive is not None for mount in self._mounts.values()),
+            }
@@ -0,0 +1,260 @@
+import os
+import struct
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from datarchive import BASE_KEY, COLUMNS, OFFSET_FIELD, ORIGINAL_SIZE_FIELD, SIZE_FIELD, Archive, copy_range
+from datdecrypt import CHUNK_SIZE, Cipher, calculate_checksums, generate_content_sbox, generate_header_key, to_uint32
+from datextract import entry_path
+from datfile import replace_atomically
+
+# Below this many bytes of payload to encrypt, worker processes cost more
+# than they save and write() encrypts in-process.
+PARALLEL_BYTES = 4 * 1024 * 1024
+
+_WORD = struct.Struct('<I')
+
+# Metadata words that do not locate or size the payload (cryptflag and
+# unk4 with the current datarchive layout); they are stored as given.
+_OTHER_COLUMNS = tuple(column for column in COLUMNS if column not in (OFFSET_FIELD, SIZE_FIELD, ORIGINAL_SIZE_FIELD))
+
+# payload is the plaintext when encrypt is set, else the bytes to store (a
+# bytes-like object or a _Copy of another archive's payload). words holds
+# the _OTHER_COLUMNS values.
+_Item = namedtuple('_Item', 'name size original_size filekey payload encrypt words')
+_Copy = namedtuple('_Copy', 'archive offset size')
+
+
+def encrypt_payload(filekey, data, chunk_size=CHUNK_SIZE):
+    # Cipher(filekey).stream_encrypt(data, len(data)) a chunk at a time: the
+    # carry of each chunk's addition goes into the next one, so the result is
+    # the same single big addition stream_decrypt undoes.
+    size = len(data)
+    cipher = Cipher(filekey)
+    out = bytearray(size)
+    keystream = bytearray(min(chunk_size, size))
+    carry = 0
+    for pos in range(0, size, chunk_size):
+        n = min(chunk_size, size - pos)
+        cipher.keystream_into(keystream, n)
+        value = int.from_bytes(data[pos:pos + n], 'little') + int.from_bytes(keystream[:n], 'little') + carry
+        out[pos:pos + n] = (value & ((1 << (n * 8)) - 1)).to_bytes(n, 'little')
+        carry = value >> (n * 8)
+    return out
+
+
+def _encrypt_fields(cipher, fields):
+    # One stream_encrypt per field, with the keystream generated in one go.
+    total = sum(len(field) for field in fields)
+    keystream = bytearray(total)
+    cipher.keystream_into(keystream, total)
+    out = bytearray(total)
+    pos = 0
+    for field in fields:
+        n = len(field)
+        value = int.from_bytes(field, 'little') + int.from_bytes(keystream[pos:pos + n], 'little')
+        out[pos:pos + n] = (value & ((1 << (n * 8)) - 1)).to_bytes(n, 'little')
+        pos += n
+    return out
+
+
+class ArchiveWriter:
+    """Builds a .dat archive that Archive can read back.
+
+    add() takes plaintext and encrypts it with the entry's filekey;
+    add_stored() takes a payload exactly as it should appear in the file.
+    Nothing is written until write(). The header and metadata keys derive
+    from the file name, so the archive has to keep the name of ``path``.
+    ``pad(n)`` supplies the n filler bytes around the header (zeros by
+    default). The metadata words other than the located ones and cryptflag
+    (unk4 with the current layout) are passed as keywords and default to 0.
+    """
+
+    def __init__(self, path, base_key=BASE_KEY, version=1, pad=bytes):
+        self.path = path
+        self.base_key = base_key
+        self.version = version
+        self.pad = pad
+        self.items = []
+
+    def add(self, name, data, cryptflag=1, filekey=None, original_size=None, **words):
+        if filekey is None:
+            filekey = os.urandom(16)
+        if len(filekey) != 16:
+            raise ValueError("Key must be 16 bytes long.")
+        size = len(data)
+        self.items.append(_Item(name, size, size if original_size is None else original_size, bytes(filekey), data, bool(cryptflag and size), _words(cryptflag, words)))
+
+    def add_stored(self, name, payload, cryptflag, filekey, original_size, **words):
+        size = payload.size if isinstance(payload, _Copy) else len(payload)
+        self.items.append(_Item(name, size, original_size, bytes(filekey), payload, False, _words(cryptflag, words)))
+
+    def _header(self):
+        name = os.path.basename(self.path)
+        combined_string = name + self.base_key
+        offset1, offset2_seed, _ = calculate_checksums(name)
+        header_cipher = Cipher(generate_header_key(combined_string))
+        count = len(self.items)
+        head = bytearray(self.pad(offset1))
+        head += header_cipher.stream_encrypt(_WORD.pack(to_uint32(count + self.version)), 4)
+        head += header_cipher.stream_encrypt(bytes([self.version]), 1)
+        head += header_cipher.stream_encrypt(_WORD.pack(count), 4)
+        head += self.pad(offset2_seed)
+        return head, Cipher(generate_content_sbox(combined_string, offset1 + offset2_seed)[:16])
+
+    def _metadata(self, cipher, start):
+        names = [item.name.encode('utf-16-le') for item in self.items]
+        offset = start + sum(4 + len(name) + 20 + 16 for name in names)
+        fields = []
+        for item, name in zip(self.items, names):
+            fields.append(_WORD.pack(len(name) // 2))
+            if name:
+                fields.append(name)
+            values = dict(item.words)
+            values.update({OFFSET_FIELD: offset, SIZE_FIELD: item.size, ORIGINAL_SIZE_FIELD: item.original_size})
+            for column in COLUMNS:
+                fields.append(_WORD.pack(values[column]))
+            fields.append(item.filekey)
+            offset += item.size
+        return _encrypt_fields(cipher, fields)
+
+    def write(self, workers=None):
+        """Writes the archive (via a temporary file) and returns its size.
+
+        Payloads to encrypt are spread over ``workers`` processes when there
+        is enough of them (0 keeps everything in-process); they are written
+        in order as they complete.
+        """
+        head, content_cipher = self._header()
+        metadata = self._metadata(content_cipher, len(head))
+        jobs = [item for item in self.items if item.encrypt]
+        pool = None
+        results = {}
+        if workers != 0 and sum(item.size for item in jobs) >= PARALLEL_BYTES and len(jobs) > 1:
+            pool = ProcessPoolExecutor(workers)
+            results = {id(item): pool.submit(encrypt_payload, item.filekey, bytes(item.payload)) for item in jobs}
+        try:
+            with replace_atomically(self.path) as out:
+                out.write(head)
+                out.write(metadata)
+                written = len(head) + len(metadata)
+                for item in self.items:
+                    payload = item.payload
+                    if item.encrypt:
+                        future = results.get(id(item))
+                        payload = future.result() if future is not None else encrypt_payload(item.filekey, payload)
+                    elif isinstance(payload, _Copy):
+                        if copy_range(payload.archive._file, out, payload.offset, payload.size):
+                            written += payload.size
+                            continue
+                        payload = payload.archive.view[payload.offset:payload.offset + payload.size]
+                    out.write(payload)
+                    written += item.size
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        return written
+
+
+def _words(cryptflag, words):
+    unknown = set(words) - set(_OTHER_COLUMNS)
+    if unknown:
+        raise TypeError(f"Not a stored metadata field: {', '.join(sorted(unknown))}.")
+    values = dict.fromkeys(_OTHER_COLUMNS, 0)
+    values.update(words, cryptflag=cryptflag)
+    return values
+
+
+def repack(src_path, dest_path, changes, workers=None, base_key=BASE_KEY):
+    """Writes a copy of an archive with some entries changed.
+
+    ``changes`` maps entry names to their new plaintext, to a (plaintext,
+    original_size) pair, or to None to drop the entry; names the archive
+    does not have are appended as new encrypted entries. Unchanged payloads
+    are copied byte for byte; changed ones are re-encrypted with their old
+    filekey and flags. Returns the number of entries re-encrypted.
+    """
+    pending = dict(changes)
+    with Archive(src_path, base_key) as archive:
+        writer = ArchiveWriter(dest_path, base_key, archive.version)
+        for row in range(len(archive.entries)):
+            entry = archive.entries[row]
+            words = {column: getattr(entry, column) for column in _OTHER_COLUMNS if column != 'cryptflag'}
+            if entry.name not in pending:
+                writer.add_stored(entry.name, _Copy(archive, entry.offset, entry.size), entry.cryptflag, entry.filekey, entry.original_size, **words)
+                continue
+            change = pending.pop(entry.name)
+            if change is None:
+                continue
+            data, original_size = change if isinstance(change, tuple) else (change, None)
+            writer.add(entry.name, data, entry.cryptflag, entry.filekey, original_size, **words)
+        for name, change in pending.items():
+            if change is None:
+                raise KeyError(f"{archive.name} has no entry {name!r} to remove.")
+            data, original_size = change if isinstance(change, tuple) else (change, None)
+            writer.add(name, data, original_size=original_size)
+        writer.write(workers)
+    return sum(change is not None for change in changes.values())
+
+
+def read_changes(changes_dir, entry_names, add=False):
+    """Reads the files under ``changes_dir`` keyed by entry name.
+
+    ``changes_dir`` is laid out like the datextract output of one archive
+    whose entries are ``entry_names``. Each file is matched to the entry
+    datextract.entry_path would have written it for, so names it normalised
+    (leading or doubled separators, '.' and '..' parts, '/') keep their
+    original spelling. Files matching no entry are a ValueError unless
+    ``add`` is set, in which case they become new entries named by their
+    relative path with backslash separators.
+    """
+    # entry_path(changes_dir, '', name) is changes_dir joined with the parts
+    # datextract keeps of the name.
+    by_path = {}
+    for name in entry_names:
+        by_path.setdefault(os.path.normcase(entry_path(changes_dir, '', name)), []).append(name)
+    changes = {}
+    unmatched = []
+    for root, dirs, files in os.walk(changes_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            names = by_path.get(os.path.normcase(path))
+            if names is None:
+                if not add:
+                    unmatched.append(path)
+                    continue
+                names = [os.path.relpath(path, changes_dir).replace(os.sep, '\\')]
+            elif len(names) > 1:
+                raise ValueError(f"{path} matches several entries: {', '.join(map(repr, names))}.")
+            with open(path, 'rb') as f:
+                changes[names[0]] = f.read()
+    if unmatched:
+        raise ValueError(f"{len(unmatched)} file(s) match no entry (use --add to append them): {', '.join(unmatched[:5])}")
+    return changes
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Repack a .dat archive, re-encrypting only changed entries.")
+    parser.add_argument('src')
+    parser.add_argument('dest', help="output archive; its file name determines the keys")
+    parser.add_argument('--changes', help="directory of replacement files, laid out like datextract output for this archive")
+    parser.add_argument('--add', action='store_true', help="append files under --changes that match no entry as new entries")
+    parser.add_argument('--delete', action='append', default=[], metavar='NAME', help="entry to drop (repeatable)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (0: none, default: CPU count)")
+    args = parser.parse_args(argv)
+    changes = {}
+    if args.changes:
+        with Archive(args.src) as archive:
+            names = [archive.entries.name(row) for row in range(len(archive.entries))]
+        changes = read_changes(args.changes, names, args.add)
+    changes.update(dict.fromkeys(args.delete))
+    count = repack(args.src, args.dest, changes, args.jobs)
+    print(f"Repacked {args.dest}: {count} entries re-encrypted, {len(args.delete)} removed.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import numpy as np
+
+from talescrypto import PacketCipher
+
+# Packets are processed as padded uint8 matrices; rows are sorted by length
+# and cut into groups of at most this many so that one long packet does not
+# pad out millions of short ones.
+GROUP_ROWS = 65536
+
+
+def _cipher(key):
+    return key if isinstance(key, PacketCipher) else PacketCipher(key)
+
+
+def _tables(tables):
+    return np.frombuffer(b''.join(tables), dtype=np.uint8).reshape(len(tables), 256)
+
+
+def _groups(lengths, group_rows):
+    order = np.argsort(lengths, kind='stable')
+    for start in range(0, len(order), group_rows):
+        rows = order[start:start + group_rows]
+        yield rows, int(lengths[rows[-1]]) if len(rows) else 0
+
+
+def _gather(data, starts, lengths, width):
+    # (len(starts), width) matrix of data[start:start + length], zero padded.
+    columns = np.arange(width)
+    inside = columns[None, :] < lengths[:, None]
+    index = np.where(inside, starts[:, None] + columns[None, :], 0)
+    return np.where(inside, data[index], 0).astype(np.uint8)
+
+
+def decrypt_capture(key, buffer, offsets, ends=None, group_rows=GROUP_ROWS):
+    """Decrypts the frames starting at ``offsets`` inside one capture buffer.
+
+    ``ends`` bounds how far each frame may read (default: the buffer end), the
+    same way slicing a short frame does in decrypt(). Returns one entry per
+    offset: None for frames not starting with 0xAA, else a uint8 view into a
+    shared result matrix (no per-packet copy).
+    """
+    cipher = _cipher(key)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    ends = np.full(len(offsets), len(data), dtype=np.int64) if ends is None else np.asarray(ends, dtype=np.int64)
+    if len(data) < 4:
+        # Too short for any frame header.
+        return [None] * len(offsets)
+    valid = (offsets + 3 < ends) & (data[np.minimum(offsets, len(data) - 1)] == 0xAA)
+    header = np.where(valid, offsets, 0)
+    declared = (data[header + 1].astype(np.int64) << 8) | data[header + 2]
+    starts = offsets + 4
+    lengths = np.where(valid, np.clip(np.minimum(declared - 1, ends - starts), 0, None), 0)
+
+    tables = _tables(cipher._decrypt_tables)
+    first = cipher.key[11]
+    result = [None] * len(offsets)
+    for rows, width in _groups(lengths, group_rows):
+        if width == 0:
+            matrix = np.empty((len(rows), 0), dtype=np.uint8)
+        else:
+            cipher_bytes = _gather(data, starts[rows], lengths[rows], width)
+            chained = tables[(np.arange(width) % len(tables))[None, :], cipher_bytes]
+            matrix = np.empty_like(chained)
+            matrix[:, 0] = chained[:, 0] ^ first
+            np.bitwise_xor(chained[:, 1:], chained[:, :-1], out=matrix[:, 1:])
+        for i, row in enumerate(rows):
+            if valid[row]:
+                result[row] = matrix[i, :lengths[row]]
+    return result
+
+
+def decrypt_batch(key, packets, group_rows=GROUP_ROWS):
+    # Like [decrypt(key, p) for p in packets], as views into shared matrices.
+    sizes = np.fromiter((len(p) for p in packets), dtype=np.int64, count=len(packets))
+    ends = np.cumsum(sizes)
+    return decrypt_capture(key, b''.join(packets), ends - sizes, ends, group_rows)
+
+
+def encrypt_batch(key, payloads, sendindexes, group_rows=GROUP_ROWS):
+    """Frames and encrypts many payloads; like encrypt(key, p, i) for each.
+
+    Returns uint8 views of whole frames (header included) into shared
+    matrices. ``sendindexes`` is one sequence number per payload.
+    """
+    cipher = _cipher(key)
+    lengths = np.fromiter((len(p) for p in payloads), dtype=np.int64, count=len(payloads))
+    sendindexes = np.asarray(sendindexes, dtype=np.int64)
+    if np.any((lengths + 1) >> 8 > 0xFF) or np.any((sendindexes < 0) | (sendindexes > 0xFF)):
+        raise ValueError("byte must be in range(0, 256)")
+    data = np.frombuffer(b''.join(payloads), dtype=np.uint8)
+    starts = np.cumsum(lengths) - lengths
+
+    tables = _tables(cipher._encrypt_tables)
+    result = [None] * len(payloads)
+    for rows, width in _groups(lengths, group_rows):
+        frames = np.zeros((len(rows), 4 + width), dtype=np.uint8)
+        frames[:, 0] = 0xAA
+        frames[:, 1] = (lengths[rows] + 1) >> 8
+        frames[:, 2] = (lengths[rows] + 1) & 0xFF
+        frames[:, 3] = sendindexes[rows]
+        if width:
+            plain = _gather(data, starts[rows], lengths[rows], width)
+            plain[:, 0] ^= cipher.key[11]
+            chained = np.bitwise_xor.accumulate(plain, axis=1)
+            frames[:, 4:] = tables[(np.arange(width) % len(tables))[None, :], chained]
+        for i, row in enumerate(rows):
+            result[row] = frames[i, :4 + lengths[row]]
+    return result
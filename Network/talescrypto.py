@@ -1,18 +1,98 @@
-def gen_key(key_seed):
-    keyblob = bytearray(open("keyblob.bin", "rb").read())
+import functools
+import mmap
+import time
+
+KEYBLOB_PATH = "keyblob.bin"
+KEY_CACHE_SIZE = 4096
+
+_keyblob = None
+# Instrumentation hooks (a talesmetrics.Metrics or anything with the same
+# packet/malformed/timing methods); None disables them.
+metrics = None
+
+
+def set_metrics(hooks):
+    global metrics
+    metrics = hooks
+
+
+def load_keyblob(path=KEYBLOB_PATH):
+    # Maps the keyblob once per process; gen_key maps the default path on
+    # first use. Reloading drops every derived key.
+    global _keyblob
+    with open(path, "rb") as f:
+        _keyblob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _derive_key.cache_clear()
+    return _keyblob
+
+
+def key_window(key_seed):
     size = (key_seed >> 0x14 ^ key_seed >> 8 & 0xff) & 0xf ^ key_seed >> 0x14 & 0xff
     offset = (key_seed >> 0xc & 0xf00 | key_seed >> 4 & 0xf | key_seed >> 8 & 0xf0 | key_seed >> 0x10 & 0xf000)
-    keyblob = keyblob[offset:offset+size]
+    return offset, size
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def _derive_key(offset, size):
+    keyblob = _keyblob[offset:offset+size]
     key_size, kout, j = len(keyblob), bytearray(range(256)), 0
     for i in range(256):
         j = (j + kout[i] + keyblob[i % key_size]) % 256
         kout[i], kout[j] = kout[j], kout[i]
     kout[0:0] = bytes.fromhex('02 00 00 00 01 00 00 00 01 01 01 00')
     kout[11:12] = kout[12:13]
-    return kout
+    return bytes(kout)
+
+
+def set_key_cache_size(maxsize):
+    # None for unbounded; the current contents are dropped.
+    global _derive_key
+    _derive_key = functools.lru_cache(maxsize=maxsize)(_derive_key.__wrapped__)
+
+
+def gen_key(key_seed):
+    # The seed only selects an (offset, size) window of the keyblob, so keys
+    # are memoized per window.
+    hooks = metrics
+    if hooks is not None:
+        start = time.perf_counter()
+    if _keyblob is None:
+        load_keyblob()
+    key = bytearray(_derive_key(*key_window(key_seed)))
+    if hooks is not None:
+        hooks.timing('gen_key', time.perf_counter() - start)
+    return key
+
+
+def warm_up(seeds, limit=None):
+    # Derives the keys of the given seeds ahead of time (e.g. the seeds seen
+    # in earlier captures), at most `limit` distinct windows (default: the
+    # cache size). Returns how many windows were derived. There is no "every
+    # window" mode: seeds can select ~16.7M windows (any keyblob offset with
+    # any non-zero size), far more keys than are worth holding, and there is
+    # no telling which of them a server will actually hand out.
+    if seeds is None:
+        raise ValueError("warm_up() needs the seeds to derive keys for.")
+    if _keyblob is None:
+        load_keyblob()
+    if limit is None:
+        limit = _derive_key.cache_info().maxsize
+    count = 0
+    for offset, size in dict.fromkeys(key_window(seed) for seed in seeds):
+        if limit is not None and count >= limit:
+            break
+        if not size or offset >= len(_keyblob):
+            # gen_key cannot derive these either.
+            continue
+        _derive_key(offset, size)
+        count += 1
+    return count
 
 
 def encrypt(key: bytes, packet_buff_in: bytes, sendindex: int) -> bytes:
+    hooks = metrics
+    if hooks is not None:
+        start = time.perf_counter()
     packet_len = len(packet_buff_in)
     packet_buff_out = bytearray(packet_len)
     loop_index = 1
@@ -42,19 +122,25 @@ def encrypt(key: bytes, packet_buff_in: bytes, sendindex: int) -> bytes:
     final_packet_buff[3] = sendindex  #seq number
     final_packet_buff[4] = 0
     final_packet_buff[4:] = packet_buff_out[:]
+    if hooks is not None:
+        hooks.timing('encrypt', time.perf_counter() - start)
+        hooks.packet('out', packet_len, sendindex, packet_buff_in[0])
     return bytes(final_packet_buff)
 
 
 
 def decrypt(key, encpack):
+    hooks = metrics
+    if hooks is not None:
+        start = time.perf_counter()
     if encpack[0] == 0xAA:
         packet_length = (encpack[1] << 8) | encpack[2]
-        print('p_len :'+str(packet_length))
         sequence_number = encpack[3]
-        print('seq_num :'+str(sequence_number))
         packet_buff_in = encpack[4:4 + packet_length-1]
         header = encpack[:4]
     else:
+        if hooks is not None:
+            hooks.malformed('in')
         return None
     packet_len = len(packet_buff_in)
     packet_buff_out = bytearray(packet_len)
@@ -99,5 +185,152 @@ def decrypt(key, encpack):
         temp_byte2 ^= temp_byte3
 
     P_Cat = packet_buff_out[0]
-    print('P_Cat :'+str(P_Cat))
-    return  packet_buff_out
\ No newline at end of file
+    if hooks is not None:
+        hooks.timing('decrypt', time.perf_counter() - start)
+        hooks.packet('in', packet_len, sequence_number, P_Cat)
+    return  packet_buff_out
+
+
+def _encrypt_table(key, loop_index):
+    # encrypt()'s round chain for one starting key position, for every v12.
+    table = bytearray(256)
+    for v12 in range(256):
+        lp = loop_index
+        v9 = (key[lp + 12] ^ v12) % 256
+        v7 = (lp + 1) % 256
+        v10 = (key[v7 + 12] + v9) % 256
+        lp = (v7 + 1) % 256
+        j = 1
+        while key[0] > j:
+            v11 = (key[lp + 12] ^ v10) % 256
+            v8 = (lp + 1) % 256
+            v10 = (key[v8 + 12] + v11) % 256
+            lp = (v8 + 1) % 256
+            j += 1
+        table[v12] = v10
+    return bytes(table)
+
+
+def _decrypt_table(key, temp_byte1):
+    # decrypt()'s per-byte transform for one starting key position, for every
+    # ciphertext byte, with the temp_byte2 chaining XOR left out.
+    xor_buf1 = bytearray(16 * ((key[0] + 30) >> 4))
+    xor_buf2 = bytearray(16 * ((key[0] + 30) >> 4))
+    for j in range(key[0]):
+        xor_buf2[j] = key[temp_byte1 + 12]
+        temp_byte1 = (temp_byte1 + 1) % 256
+        xor_buf1[j] = key[temp_byte1 + 12]
+        temp_byte1 = (temp_byte1 + 1) % 256
+    xor_ptr2 = xor_buf2[key[4]:]
+    xor_ptr1 = xor_buf1[key[4]:]
+    table = bytearray(256)
+    for temp_byte3 in range(256):
+        value = temp_byte3
+        j = key[4]
+        while j > 0:
+            if xor_ptr1[j-1] > value:
+                value += ~xor_ptr1[j-1]
+                value += 1
+            else:
+                value -= xor_ptr1[j-1]
+            value = (value ^ xor_ptr2[j-1]) % 256
+            j -= 1
+        if xor_buf1[0] > value:
+            value += ~xor_buf1[0]
+            value += 1
+        else:
+            value -= xor_buf1[0]
+        table[temp_byte3] = (value ^ xor_buf2[0]) % 256
+    return bytes(table)
+
+
+def _positions(step):
+    # Key positions a packet walks through, starting at 1, until they repeat.
+    positions = [1]
+    while (positions[-1] + step) % 256 != 1:
+        positions.append((positions[-1] + step) % 256)
+    return positions
+
+
+def _translate(data, tables):
+    # out[i] = tables[i % len(tables)][data[i]], one C-level pass per table.
+    period = len(tables)
+    if period == 1:
+        return bytearray(data.translate(tables[0]))
+    out = bytearray(len(data))
+    for residue, table in enumerate(tables):
+        out[residue::period] = data[residue::period].translate(table)
+    return out
+
+
+def _prefix_xor(data):
+    # out[i] = data[0] ^ ... ^ data[i], as log2(n) whole-buffer XOR-shifts.
+    n = len(data)
+    value = int.from_bytes(data, 'little')
+    mask = (1 << (n * 8)) - 1
+    shift = 8
+    while shift < n * 8:
+        value = (value ^ (value << shift)) & mask
+        shift *= 2
+    return value.to_bytes(n, 'little')
+
+
+class PacketCipher:
+    """encrypt()/decrypt() for one session key, precomputed.
+
+    The key positions used for byte i only depend on i (they cycle mod 256),
+    so the whole round chain of every position is folded into a 256-entry
+    table when the session key is set. The remaining data dependency is the
+    chaining XOR: encrypt chains a prefix XOR of the plaintext, and decrypt's
+    temp_byte2 after byte i is just that byte's table value, so decrypted
+    byte i is table value i XOR table value i-1. Output matches encrypt() and
+    decrypt() exactly and reports to the same instrumentation hooks.
+    """
+
+    def __init__(self, key):
+        self.key = bytes(key)
+        # encrypt() always runs its first round, decrypt() runs key[0] rounds.
+        self._encrypt_tables = [_encrypt_table(self.key, p) for p in _positions(2 * max(self.key[0], 1))]
+        self._decrypt_tables = [_decrypt_table(self.key, p) for p in _positions(2 * self.key[0])]
+
+    def encrypt_payload(self, packet_buff_in):
+        n = len(packet_buff_in)
+        if n == 0:
+            return bytearray()
+        chained = _prefix_xor(bytes([self.key[11] ^ packet_buff_in[0]]) + bytes(packet_buff_in[1:]))
+        return _translate(chained, self._encrypt_tables)
+
+    def decrypt_payload(self, packet_buff_in):
+        n = len(packet_buff_in)
+        if n == 0:
+            return bytearray()
+        chained = _translate(bytes(packet_buff_in), self._decrypt_tables)
+        previous = bytes([self.key[11]]) + chained[:-1]
+        return bytearray((int.from_bytes(chained, 'little') ^ int.from_bytes(previous, 'little')).to_bytes(n, 'little'))
+
+    def encrypt(self, packet_buff_in, sendindex):
+        hooks = metrics
+        if hooks is not None:
+            start = time.perf_counter()
+        packet_len = len(packet_buff_in)
+        header = bytes([0xAA, (packet_len + 1) >> 8, (packet_len + 1) & 0xFF, sendindex])
+        out = header + self.encrypt_payload(packet_buff_in)
+        if hooks is not None:
+            hooks.timing('encrypt', time.perf_counter() - start)
+            hooks.packet('out', packet_len, sendindex, packet_buff_in[0] if packet_len else None)
+        return out
+
+    def decrypt(self, encpack):
+        hooks = metrics
+        if hooks is not None:
+            start = time.perf_counter()
+        if encpack[0] != 0xAA:
+            if hooks is not None:
+                hooks.malformed('in')
+            return None
+        packet_length = (encpack[1] << 8) | encpack[2]
+        out = self.decrypt_payload(encpack[4:4 + packet_length-1])
+        if hooks is not None:
+            hooks.timing('decrypt', time.perf_counter() - start)
+            hooks.packet('in', len(out), encpack[3], out[0] if out else None)
+        return out
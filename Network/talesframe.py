@@ -0,0 +1,98 @@
+HEADER_SIZE = 4
+FRAME_MARKER = 0xAA
+# The length field counts the payload plus one, so the largest frame the
+# header can describe is 3 + 0xFFFF bytes.
+MAX_FRAME_SIZE = 0xFFFF + 3
+
+
+def frame_size(length_field):
+    return HEADER_SIZE + length_field - 1
+
+
+class FrameDecoder:
+    """Splits a TCP byte stream into 0xAA frames.
+
+    feed() takes chunks of any size and returns the frames completed so far
+    as memoryviews (header included, ready for decrypt/PacketCipher.decrypt)
+    into one reusable buffer. They stay valid until the next feed() call;
+    copy anything that has to live longer.
+
+    Bytes that cannot start a frame are skipped up to the next 0xAA, and a
+    header that is malformed or announces a frame larger than max_frame_size
+    is treated as garbage too. Sequence numbers are expected to count up by
+    one mod 256; jumps are counted in seq_gaps / seq_missing.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, buffer_size=64 * 1024):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray(max(buffer_size, HEADER_SIZE))
+        self._start = 0
+        self._end = 0
+        self.expected_seq = None
+        self.frames = 0
+        self.bytes = 0
+        self.garbage_bytes = 0
+        self.malformed = 0
+        self.seq_gaps = 0
+        self.seq_missing = 0
+
+    @property
+    def pending(self):
+        # Bytes buffered towards an incomplete frame.
+        return self._end - self._start
+
+    def _append(self, data):
+        size = len(data)
+        pending = self._end - self._start
+        if pending + size > len(self._buffer):
+            # Never resize in place: frames handed out earlier may still be
+            # referenced, so a bigger buffer is a new one.
+            buffer = bytearray(max(2 * len(self._buffer), pending + size))
+            buffer[:pending] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+        elif self._start:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        self._start, self._end = 0, pending + size
+        self._buffer[pending:self._end] = data
+
+    def _resync(self, pos, end, search_from):
+        # Advance to the next frame marker, counting what is skipped.
+        marker = self._buffer.find(FRAME_MARKER, search_from, end)
+        marker = end if marker < 0 else marker
+        self.garbage_bytes += marker - pos
+        return marker
+
+    def feed(self, data):
+        self._append(data)
+        buffer, view = self._buffer, memoryview(self._buffer)
+        pos, end = self._start, self._end
+        frames = []
+        while pos < end:
+            if buffer[pos] != FRAME_MARKER:
+                pos = self._resync(pos, end, pos)
+                continue
+            if end - pos < HEADER_SIZE:
+                break
+            length = (buffer[pos + 1] << 8) | buffer[pos + 2]
+            size = frame_size(length)
+            if length == 0 or size > self.max_frame_size:
+                self.malformed += 1
+                pos = self._resync(pos, end, pos + 1)
+                continue
+            if end - pos < size:
+                break
+            seq = buffer[pos + 3]
+            if self.expected_seq is not None and seq != self.expected_seq:
+                self.seq_gaps += 1
+                self.seq_missing += (seq - self.expected_seq) & 0xFF
+            self.expected_seq = (seq + 1) & 0xFF
+            frames.append(view[pos:pos + size])
+            self.frames += 1
+            self.bytes += size
+            pos += size
+        self._start = pos
+        return frames
+
+    def reset(self):
+        self._start = self._end = 0
+        self.expected_seq = None
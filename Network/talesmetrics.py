@@ -0,0 +1,189 @@
+import bisect
+import json
+import threading
+
+# Packets decrypted by talescrypto count as 'in', encrypted ones as 'out'.
+# Other callers (the proxy: c2s/s2c) report packets and track frame
+# decoders under their own direction names.
+IN = 'in'
+OUT = 'out'
+DECODER_COUNTERS = ('frames', 'bytes', 'garbage_bytes', 'malformed', 'seq_gaps', 'seq_missing')
+# Latency histogram bucket upper bounds: 1us doubling up to ~1s.
+LATENCY_BUCKETS = tuple(1e-6 * 2 ** i for i in range(21))
+
+
+class Histogram:
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {'bounds': list(self.bounds), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+class _Direction:
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.opcodes = [0] * 257  # last slot: empty payloads
+        self.malformed = 0
+
+
+class Metrics:
+    """Counters and latency histograms fed by the talescrypto hooks.
+
+    Install with talescrypto.set_metrics(Metrics()); while none is set the
+    crypto functions only pay one `is not None` check. FrameDecoders passed to
+    track() are read when a snapshot is taken, so framing adds no per-packet
+    cost at all. Updates are not locked: counts from concurrent threads may
+    be off by a few, which is fine for telemetry.
+    """
+
+    def __init__(self):
+        self.directions = {}
+        self.latency = {}
+        self._decoders = []
+        self._retired = {}
+
+    def _direction(self, direction):
+        state = self.directions.get(direction)
+        if state is None:
+            state = self.directions[direction] = _Direction()
+        return state
+
+    # Hooks called by talescrypto.
+    def packet(self, direction, size, seq, opcode):
+        state = self.directions.get(direction) or self._direction(direction)
+        state.packets += 1
+        state.bytes += size
+        state.opcodes[256 if opcode is None else opcode] += 1
+
+    def malformed(self, direction):
+        self._direction(direction).malformed += 1
+
+    def timing(self, operation, seconds):
+        histogram = self.latency.get(operation)
+        if histogram is None:
+            histogram = self.latency[operation] = Histogram()
+        histogram.observe(seconds)
+
+    # FrameDecoder statistics.
+    def track(self, decoder, direction):
+        self._decoders.append((decoder, direction))
+
+    def untrack(self, decoder):
+        # Keeps the counts of a decoder that is going away.
+        for i, (tracked, direction) in enumerate(self._decoders):
+            if tracked is decoder:
+                del self._decoders[i]
+                totals = self._retired.setdefault(direction, dict.fromkeys(DECODER_COUNTERS, 0))
+                for name in DECODER_COUNTERS:
+                    totals[name] += getattr(decoder, name)
+                return
+
+    def _framing(self):
+        framing = {direction: dict(totals) for direction, totals in self._retired.items()}
+        for decoder, direction in list(self._decoders):
+            totals = framing.setdefault(direction, dict.fromkeys(DECODER_COUNTERS, 0))
+            for name in DECODER_COUNTERS:
+                totals[name] += getattr(decoder, name)
+        return framing
+
+    def snapshot(self):
+        directions = {}
+        for name, state in self.directions.items():
+            opcodes = {f"0x{op:02x}": count for op, count in enumerate(state.opcodes[:256]) if count}
+            if state.opcodes[256]:
+                opcodes['empty'] = state.opcodes[256]
+            directions[name] = {'packets': state.packets, 'bytes': state.bytes, 'malformed': state.malformed, 'opcodes': opcodes}
+        return {
+            'directions': directions,
+            'latency': {name: histogram.snapshot() for name, histogram in self.latency.items()},
+            'framing': self._framing(),
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def prometheus(self, prefix='tales'):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, samples):
+            if samples:
+                lines.append(f"# TYPE {prefix}_{name} {kind}")
+                lines.extend(f"{prefix}_{name}{labels} {value}" for labels, value in samples)
+
+        directions = snapshot['directions']
+        metric('packets_total', 'counter', [(f'{{direction="{d}"}}', s['packets']) for d, s in directions.items()])
+        metric('bytes_total', 'counter', [(f'{{direction="{d}"}}', s['bytes']) for d, s in directions.items()])
+        metric('opcode_packets_total', 'counter', [(f'{{direction="{d}",opcode="{op}"}}', n) for d, s in directions.items() for op, n in s['opcodes'].items()])
+        malformed = {d: s['malformed'] for d, s in directions.items()}
+        for d, totals in snapshot['framing'].items():
+            malformed[d] = malformed.get(d, 0) + totals['malformed']
+        metric('malformed_frames_total', 'counter', [(f'{{direction="{d}"}}', n) for d, n in malformed.items()])
+        for name in ('frames', 'garbage_bytes', 'seq_gaps', 'seq_missing'):
+            metric(f'framing_{name}_total', 'counter', [(f'{{direction="{d}"}}', t[name]) for d, t in snapshot['framing'].items()])
+
+        samples = []
+        for operation, histogram in snapshot['latency'].items():
+            cumulative = 0
+            for bound, count in zip(histogram['bounds'] + ['+Inf'], histogram['counts']):
+                cumulative += count
+                samples.append((f'_bucket{{op="{operation}",le="{bound}"}}', cumulative))
+            samples.append((f'_sum{{op="{operation}"}}', histogram['sum']))
+            samples.append((f'_count{{op="{operation}"}}', histogram['count']))
+        if samples:
+            lines.append(f"# TYPE {prefix}_latency_seconds histogram")
+            lines.extend(f"{prefix}_latency_seconds{labels} {value}" for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+class Tracer:
+    # Hooks printing what decrypt() used to print for every packet.
+
+    def packet(self, direction, size, seq, opcode):
+        if direction == IN:
+            print('p_len :' + str(size + 1))
+            print('seq_num :' + str(seq))
+            print('P_Cat :' + str(opcode))
+
+    def malformed(self, direction):
+        pass
+
+    def timing(self, operation, seconds):
+        pass
+
+
+def serve(metrics, port=9464, host='127.0.0.1'):
+    # Serves metrics.prometheus() (and /json) over HTTP from a daemon thread.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.startswith('/json'):
+                body, kind = metrics.to_json().encode(), 'application/json'
+            else:
+                body, kind = metrics.prometheus().encode(), 'text/plain; version=0.0.4'
+            self.send_response(200)
+            self.send_header('Content-Type', kind)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
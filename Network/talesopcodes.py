@@ -0,0 +1,134 @@
+import struct
+
+# Field layouts use struct format codes, little-endian, starting right after
+# the opcode byte (P_Cat, payload[0]). A final field with format '*' takes
+# the rest of the payload.
+BYTE_ORDER = '<'
+REST = '*'
+
+
+class Packet:
+    """A decoded payload viewed through its opcode's layout.
+
+    Fields are unpacked from the underlying buffer when read, each with its
+    own precompiled struct, so touching one field costs one unpack_from.
+    """
+    __slots__ = ('buffer',)
+    opcode = None
+    _name = 'unknown'
+    _layout = ()
+    _struct = struct.Struct(BYTE_ORDER)
+
+    def __init__(self, buffer):
+        if len(buffer) < 1 + self._struct.size:
+            raise ValueError(f"{self._name} packet needs {1 + self._struct.size} bytes, got {len(buffer)}.")
+        self.buffer = buffer
+
+    @property
+    def size(self):
+        return len(self.buffer)
+
+    def fields(self):
+        return {name: getattr(self, name) for name, _ in self._layout}
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={value!r}" for name, value in self.fields().items())
+        opcode = 'empty' if self.opcode is None else f"0x{self.opcode:02x}"
+        return f"<{self._name} {opcode} {fields}>"
+
+
+class RawPacket(Packet):
+    # Payloads whose opcode has no registered layout.
+    __slots__ = ()
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    @property
+    def opcode(self):
+        return self.buffer[0] if len(self.buffer) else None
+
+    def fields(self):
+        return {'data': self.buffer[1:]}
+
+
+def _field(field_struct, offset):
+    if len(field_struct.unpack(bytes(field_struct.size))) == 1:
+        return property(lambda self: field_struct.unpack_from(self.buffer, offset)[0])
+    # Multi-value formats ('3H') come back as a tuple.
+    return property(lambda self: field_struct.unpack_from(self.buffer, offset))
+
+
+def _rest(offset):
+    return property(lambda self: self.buffer[offset:])
+
+
+def compile_layout(name, opcode, layout):
+    # Builds the Packet subclass for one opcode.
+    layout = tuple(layout)
+    attributes = {'__slots__': (), 'opcode': opcode, '_name': name, '_layout': layout}
+    offset = 1
+    fixed = BYTE_ORDER
+    for i, (field, fmt) in enumerate(layout):
+        if field.startswith('_') or hasattr(Packet, field):
+            raise ValueError(f"{name}: field name {field!r} is reserved.")
+        if fmt == REST:
+            if i != len(layout) - 1:
+                raise ValueError(f"{name}: only the last field can take the rest of the packet.")
+            attributes[field] = _rest(offset)
+            continue
+        field_struct = struct.Struct(BYTE_ORDER + fmt)
+        attributes[field] = _field(field_struct, offset)
+        offset += field_struct.size
+        fixed += fmt
+    attributes['_struct'] = struct.Struct(fixed)
+    return type(name, (Packet,), attributes)
+
+
+class Registry:
+    """Packet types and handlers by opcode.
+
+    Both live in 256-entry lists, so decode() and dispatch() are a single
+    index into a table.
+    """
+
+    def __init__(self):
+        self.types = [None] * 256
+        self.handlers = [None] * 256
+        self.default_handler = None
+
+    def define(self, opcode, name, layout):
+        if self.types[opcode] is not None:
+            raise ValueError(f"opcode 0x{opcode:02x} is already defined as {self.types[opcode]._name}.")
+        cls = self.types[opcode] = compile_layout(name, opcode, layout)
+        return cls
+
+    def decode(self, payload):
+        if not payload:
+            return RawPacket(payload)
+        return (self.types[payload[0]] or RawPacket)(payload)
+
+    def handler(self, opcode=None):
+        # Decorator registering a handler for one opcode, or for every
+        # opcode without one when opcode is None.
+        def register(func):
+            if opcode is None:
+                self.default_handler = func
+            else:
+                self.handlers[opcode] = func
+            return func
+        return register
+
+    def dispatch(self, payload, *args):
+        handler = self.handlers[payload[0]] if payload else None
+        handler = handler or self.default_handler
+        if handler is None:
+            return None
+        return handler(self.decode(payload), *args)
+
+
+REGISTRY = Registry()
+define = REGISTRY.define
+decode = REGISTRY.decode
+handler = REGISTRY.handler
+dispatch = REGISTRY.dispatch
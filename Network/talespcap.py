@@ -0,0 +1,608 @@
+import array
+import ipaddress
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import traceback
+from queue import Empty, Full
+
+from talescrypto import PacketCipher
+from talesframe import FrameDecoder
+
+# pcap magic -> (byte order, seconds per timestamp fraction unit)
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6), b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9), b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 1
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IP = {0x0800: 4, 0x86DD: 6}
+TCP = 6
+SYN = 0x02
+SEQ_MASK = 0xFFFFFFFF
+
+# Out-of-order segments held per stream before the missing data is given up
+# on (the frame decoder of that stream is reset and resyncs on the next 0xAA).
+MAX_PENDING = 256
+# Segments sent to a worker per message.
+BATCH_SEGMENTS = 8192
+# Rows a worker buffers before appending them to its column files.
+FLUSH_ROWS = 65536
+# How long the main process blocks on a worker queue before checking that
+# the workers are still alive.
+POLL_SECONDS = 0.5
+
+# Output columns: name -> (array typecode, numpy dtype string in the index).
+# opcode is P_Cat (first decrypted byte), -1 for an empty payload; offset and
+# length locate the decrypted payload in payloads.bin.
+COLUMNS = {
+    'timestamp': ('d', '<f8'),
+    'flow': ('I', '<u4'),
+    'seq': ('B', '|u1'),
+    'opcode': ('h', '<i2'),
+    'offset': ('Q', '<u8'),
+    'length': ('I', '<u4'),
+}
+PAYLOADS = 'payloads.bin'
+INDEX = 'index.json'
+
+
+def _tsresol(buf, pos, end, endian):
+    # if_tsresol option of an interface description block, default microseconds.
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(endian + 'HH', buf, pos)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = buf[pos + 4]
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        pos += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def _pcap_packets(buf):
+    endian, scale = PCAP_MAGIC[bytes(buf[:4])]
+    linktype = struct.unpack_from(endian + 'I', buf, 20)[0] & 0x0FFFFFFF
+    record = struct.Struct(endian + 'IIII')
+    pos, end = 24, len(buf)
+    while pos + 16 <= end:
+        sec, frac, caplen, _ = record.unpack_from(buf, pos)
+        pos += 16
+        if pos + caplen > end:
+            break
+        yield sec + frac * scale, linktype, pos, caplen
+        pos += caplen
+
+
+def _interface(interfaces, iface, pos):
+    if iface >= len(interfaces):
+        raise ValueError(f"pcapng packet block at offset {pos} uses interface {iface}, but its section only describes {len(interfaces)} interface(s) before it.")
+    return interfaces[iface]
+
+
+def _pcapng_packets(buf):
+    pos, end = 0, len(buf)
+    endian = '<'
+    interfaces = []
+    while pos + 12 <= end:
+        # The section header type reads the same in both byte orders.
+        btype, = struct.unpack_from(endian + 'I', buf, pos)
+        if btype == PCAPNG_SHB:
+            endian = '<' if bytes(buf[pos + 8:pos + 12]) == b'\x4d\x3c\x2b\x1a' else '>'
+            interfaces = []
+        total, = struct.unpack_from(endian + 'I', buf, pos + 4)
+        if total < 12 or pos + total > end:
+            break
+        if btype == PCAPNG_IDB:
+            linktype, = struct.unpack_from(endian + 'H', buf, pos + 8)
+            interfaces.append((linktype, _tsresol(buf, pos + 16, pos + total - 4, endian)))
+        elif btype == PCAPNG_EPB:
+            iface, high, low, caplen = struct.unpack_from(endian + 'IIII', buf, pos + 8)
+            linktype, scale = _interface(interfaces, iface, pos)
+            yield ((high << 32) | low) * scale, linktype, pos + 28, min(caplen, total - 32)
+        elif btype == PCAPNG_SPB:
+            orig_len, = struct.unpack_from(endian + 'I', buf, pos + 8)
+            yield 0.0, _interface(interfaces, 0, pos)[0], pos + 12, min(orig_len, total - 16)
+        pos += total
+
+
+def packets(buf):
+    # (timestamp, linktype, offset, length) of every packet of a pcap or
+    # pcapng capture; the packet bytes are buf[offset:offset + length].
+    if len(buf) >= 24 and bytes(buf[:4]) in PCAP_MAGIC:
+        return _pcap_packets(buf)
+    if len(buf) >= 12 and struct.unpack_from('<I', buf)[0] == PCAPNG_SHB:
+        return _pcapng_packets(buf)
+    raise ValueError("not a pcap or pcapng capture.")
+
+
+def _ip_header(buf, linktype, pos, end):
+    # Position and version of the IP header inside a link layer frame.
+    if linktype == LINKTYPE_ETHERNET:
+        if end - pos < 14:
+            return None
+        ethertype = (buf[pos + 12] << 8) | buf[pos + 13]
+        pos += 14
+        while ethertype in (0x8100, 0x88A8) and end - pos >= 4:
+            ethertype = (buf[pos + 2] << 8) | buf[pos + 3]
+            pos += 4
+        version = ETHERTYPE_IP.get(ethertype)
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        if end - pos < 4:
+            return None
+        family = int.from_bytes(buf[pos:pos + 4], 'big' if linktype == LINKTYPE_LOOP else sys.byteorder)
+        if family > 0xFFFF:
+            family = int.from_bytes(family.to_bytes(4, 'big'), 'little')
+        version = 4 if family == 2 else 6 if family in (10, 24, 28, 30) else None
+        pos += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if end - pos < 16:
+            return None
+        version = ETHERTYPE_IP.get((buf[pos + 14] << 8) | buf[pos + 15])
+        pos += 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if end - pos < 20:
+            return None
+        version = ETHERTYPE_IP.get((buf[pos] << 8) | buf[pos + 1])
+        pos += 20
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        version = buf[pos] >> 4 if pos < end else None
+    else:
+        return None
+    return (pos, version) if version else None
+
+
+def tcp_segment(buf, linktype, pos, length):
+    """Decodes a captured packet down to TCP.
+
+    Returns (src, sport, dst, dport, seq, flags, start, end) with the
+    addresses as packed bytes and the segment payload at buf[start:end], or
+    None for anything that is not an unfragmented TCP segment.
+    """
+    end = pos + length
+    ip = _ip_header(buf, linktype, pos, end)
+    if ip is None:
+        return None
+    pos, version = ip
+    if version == 4:
+        if end - pos < 20 or buf[pos + 9] != TCP:
+            return None
+        if ((buf[pos + 6] << 8) | buf[pos + 7]) & 0x3FFF:
+            return None
+        end = min(end, pos + ((buf[pos + 2] << 8) | buf[pos + 3]))
+        src, dst = bytes(buf[pos + 12:pos + 16]), bytes(buf[pos + 16:pos + 20])
+        pos += (buf[pos] & 0x0F) * 4
+    elif version == 6:
+        if end - pos < 40 or buf[pos + 6] != TCP:
+            return None
+        end = min(end, pos + 40 + ((buf[pos + 4] << 8) | buf[pos + 5]))
+        src, dst = bytes(buf[pos + 8:pos + 24]), bytes(buf[pos + 24:pos + 40])
+        pos += 40
+    else:
+        return None
+    if end - pos < 20:
+        return None
+    sport, dport, seq = struct.unpack_from('>HHI', buf, pos)
+    flags = buf[pos + 13]
+    start = pos + (buf[pos + 12] >> 4) * 4
+    return src, sport, dst, dport, seq, flags, min(start, end), end
+
+
+def _seq_after(seq, base):
+    # Signed distance from base to seq in TCP sequence space.
+    delta = (seq - base) & SEQ_MASK
+    return delta - (1 << 32) if delta & 0x80000000 else delta
+
+
+class _Stream:
+    # One direction of a TCP connection.
+    __slots__ = ('flow', 'next_seq', 'pending')
+
+    def __init__(self, flow):
+        self.flow = flow
+        self.next_seq = None
+        self.pending = {}
+
+
+class Reassembler:
+    """Puts the TCP payload of each stream back in order.
+
+    emit(flow, timestamp, offset, length) is called with in-order, non
+    overlapping ranges of the capture buffer; length 0 means data was lost
+    and the consumer should drop whatever partial frame it holds. Each
+    direction of a connection is its own flow, numbered in order of first
+    appearance; ``flows`` lists their (src, sport, dst, dport).
+    """
+
+    def __init__(self, emit, max_pending=MAX_PENDING):
+        self.emit = emit
+        self.max_pending = max_pending
+        self.streams = {}
+        self.flows = []
+        self.lost = 0
+
+    def _stream(self, key):
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = _Stream(len(self.flows))
+            self.flows.append(key)
+        return stream
+
+    def _deliver(self, stream, seq, timestamp, start, end):
+        # Emits what is new in [seq, seq + end - start) and advances.
+        start += max(0, -_seq_after(seq, stream.next_seq))
+        if start < end:
+            self.emit(stream.flow, timestamp, start, end - start)
+            stream.next_seq = (stream.next_seq + end - start) & SEQ_MASK
+
+    def _drain(self, stream):
+        while stream.pending:
+            ready = sorted((s for s in stream.pending if _seq_after(s, stream.next_seq) <= 0), key=lambda s: _seq_after(s, stream.next_seq))
+            if not ready:
+                return
+            for seq in ready:
+                self._deliver(stream, seq, *stream.pending.pop(seq))
+
+    def _skip_gap(self, stream):
+        # Gives up on missing data and resumes at the oldest held segment.
+        seq = min(stream.pending, key=lambda s: _seq_after(s, stream.next_seq))
+        self.lost += 1
+        self.emit(stream.flow, stream.pending[seq][0], 0, 0)
+        stream.next_seq = seq
+        self._drain(stream)
+
+    def segment(self, key, timestamp, seq, flags, start, end):
+        stream = self._stream(key)
+        if flags & SYN:
+            seq = (seq + 1) & SEQ_MASK
+            if stream.next_seq is None:
+                stream.next_seq = seq
+        elif stream.next_seq is None:
+            stream.next_seq = seq
+        if start >= end:
+            return
+        if _seq_after(seq, stream.next_seq) > 0:
+            stream.pending[seq] = (timestamp, start, end)
+            if len(stream.pending) > self.max_pending:
+                self._skip_gap(stream)
+            return
+        self._deliver(stream, seq, timestamp, start, end)
+        self._drain(stream)
+
+    def feed(self, buf):
+        for timestamp, linktype, pos, length in packets(buf):
+            segment = tcp_segment(buf, linktype, pos, length)
+            if segment is not None:
+                src, sport, dst, dport, seq, flags, start, end = segment
+                self.segment((src, sport, dst, dport), timestamp, seq, flags, start, end)
+
+    def finish(self):
+        for stream in self.streams.values():
+            while stream.pending:
+                self._skip_gap(stream)
+
+
+def _write_array(f, values):
+    if sys.byteorder == 'big' and values.itemsize > 1:
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    values.tofile(f)
+
+
+class Shard:
+    """Frames and decrypts the flows assigned to one worker.
+
+    Segments arrive as (flow, timestamp, offset, length) into the mapped
+    capture; rows are appended to the column files in ``part_dir``.
+    """
+
+    def __init__(self, capture_path, key, part_dir):
+        with open(capture_path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self.cipher = PacketCipher(key)
+        self.decoders = {}
+        os.makedirs(part_dir, exist_ok=True)
+        self._files = {name: open(os.path.join(part_dir, name), 'wb') for name in COLUMNS}
+        self._payloads = open(os.path.join(part_dir, PAYLOADS), 'wb')
+        self._rows = {name: array.array(typecode) for name, (typecode, _) in COLUMNS.items()}
+        self._payload_size = 0
+        self.rows = 0
+
+    def _flush(self):
+        for name, values in self._rows.items():
+            _write_array(self._files[name], values)
+            del values[:]
+
+    def segments(self, flows, timestamps, offsets, lengths):
+        decoders, view, cipher = self.decoders, self._view, self.cipher
+        rows = self._rows
+        timestamp_col, flow_col, seq_col = rows['timestamp'], rows['flow'], rows['seq']
+        opcode_col, offset_col, length_col = rows['opcode'], rows['offset'], rows['length']
+        for flow, timestamp, offset, length in zip(flows, timestamps, offsets, lengths):
+            decoder = decoders.get(flow)
+            if decoder is None:
+                decoder = decoders[flow] = FrameDecoder()
+            if not length:
+                decoder.reset()
+                continue
+            for frame in decoder.feed(view[offset:offset + length]):
+                payload = cipher.decrypt(frame)
+                timestamp_col.append(timestamp)
+                flow_col.append(flow)
+                seq_col.append(frame[3])
+                opcode_col.append(payload[0] if payload else -1)
+                offset_col.append(self._payload_size)
+                length_col.append(len(payload))
+                self._payloads.write(payload)
+                self._payload_size += len(payload)
+            if len(flow_col) >= FLUSH_ROWS:
+                self.rows += len(flow_col)
+                self._flush()
+
+    def close(self):
+        self.rows += len(self._rows['flow'])
+        self._flush()
+        for f in self._files.values():
+            f.close()
+        self._payloads.close()
+        self._view.release()
+        self._map.close()
+        stats = {'frames': 0, 'garbage_bytes': 0, 'malformed': 0, 'seq_gaps': 0, 'seq_missing': 0}
+        for decoder in self.decoders.values():
+            for name in stats:
+                stats[name] += getattr(decoder, name)
+        stats['rows'] = self.rows
+        return stats
+
+
+def _shard_main(queue, results, capture_path, key, part_dir):
+    # Puts (part_dir, stats, None) on results, or (part_dir, None, traceback).
+    try:
+        shard = Shard(capture_path, key, part_dir)
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            shard.segments(*batch)
+        results.put((part_dir, shard.close(), None))
+    except BaseException:
+        results.put((part_dir, None, traceback.format_exc()))
+
+
+class _Workers:
+    """One Shard per worker process, fed through bounded queues.
+
+    Every blocking put or get gives up after POLL_SECONDS to check on the
+    workers, so a worker that fails or dies raises RuntimeError in the main
+    process instead of leaving it waiting forever.
+    """
+
+    def __init__(self, capture_path, key, parts):
+        self.parts = parts
+        self.queues = [multiprocessing.Queue(4) for _ in parts]
+        self.results = multiprocessing.Queue()
+        self.processes = [multiprocessing.Process(target=_shard_main, args=(queue, self.results, capture_path, key, part), daemon=True) for queue, part in zip(self.queues, parts)]
+        self.done = {}
+        for process in self.processes:
+            process.start()
+
+    def _poll(self, timeout):
+        try:
+            part, stats, error = self.results.get(timeout=timeout)
+        except Empty:
+            return False
+        if error is not None:
+            raise RuntimeError(f"worker for {os.path.basename(part)} failed:\n{error}")
+        self.done[part] = stats
+        return True
+
+    def _check(self):
+        while self._poll(0):
+            pass
+        for process, part in zip(self.processes, self.parts):
+            if part in self.done or process.is_alive():
+                continue
+            # A worker that exited normally may still have its result in flight.
+            while part not in self.done and self._poll(POLL_SECONDS):
+                pass
+            if part not in self.done:
+                raise RuntimeError(f"worker for {os.path.basename(part)} exited with code {process.exitcode}.")
+
+    def send(self, shard, batch):
+        while True:
+            try:
+                self.queues[shard].put(batch, timeout=POLL_SECONDS)
+                return
+            except Full:
+                self._check()
+
+    def finish(self):
+        # Stats of every shard, in order, once all workers are done.
+        for shard in range(len(self.parts)):
+            self.send(shard, None)
+        while len(self.done) < len(self.parts):
+            if not self._poll(POLL_SECONDS):
+                self._check()
+        for process in self.processes:
+            process.join()
+        return [self.done[part] for part in self.parts]
+
+    def terminate(self):
+        for queue in self.queues:
+            queue.cancel_join_thread()
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+class _Batches:
+    # Per-shard segment batches, handed to `send` when full.
+
+    def __init__(self, shards, send):
+        self.shards = shards
+        self.send = send
+        self.batches = [self._new() for _ in range(shards)]
+
+    @staticmethod
+    def _new():
+        return array.array('I'), array.array('d'), array.array('Q'), array.array('I')
+
+    def add(self, flow, timestamp, offset, length):
+        shard = flow % self.shards
+        batch = self.batches[shard]
+        batch[0].append(flow)
+        batch[1].append(timestamp)
+        batch[2].append(offset)
+        batch[3].append(length)
+        if len(batch[0]) >= BATCH_SEGMENTS:
+            self.send(shard, batch)
+            self.batches[shard] = self._new()
+
+    def flush(self):
+        for shard, batch in enumerate(self.batches):
+            if len(batch[0]):
+                self.send(shard, batch)
+        self.batches = [self._new() for _ in range(self.shards)]
+
+
+def _address(raw, port):
+    address = ipaddress.ip_address(raw)
+    return f"[{address}]:{port}" if address.version == 6 else f"{address}:{port}"
+
+
+def _merge(parts, out_dir):
+    # Concatenates the per-shard columns, rebasing payload offsets.
+    files = {name: open(os.path.join(out_dir, name), 'wb') for name in COLUMNS}
+    base = 0
+    with open(os.path.join(out_dir, PAYLOADS), 'wb') as payloads:
+        for part in parts:
+            for name in COLUMNS:
+                path = os.path.join(part, name)
+                if name == 'offset':
+                    offsets = array.array('Q')
+                    with open(path, 'rb') as f:
+                        offsets.frombytes(f.read())
+                    if sys.byteorder == 'big':
+                        offsets.byteswap()
+                    _write_array(files[name], array.array('Q', (o + base for o in offsets)))
+                else:
+                    with open(path, 'rb') as f:
+                        shutil.copyfileobj(f, files[name])
+            with open(os.path.join(part, PAYLOADS), 'rb') as f:
+                shutil.copyfileobj(f, payloads)
+                base = payloads.tell()
+            shutil.rmtree(part)
+    for f in files.values():
+        f.close()
+
+
+def ingest(capture_path, out_dir, key, workers=None):
+    """Reassembles, frames and decrypts every TCP stream of a capture.
+
+    The capture is mapped, not read; the main process only parses headers
+    and reassembles, and flows are spread over ``workers`` processes (0 runs
+    everything in-process) that each keep their flows in order. All flows
+    are decrypted with the one session ``key``. Writes one file per column
+    (see COLUMNS), payloads.bin and index.json to out_dir and returns the
+    index.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    os.makedirs(out_dir, exist_ok=True)
+    shards = max(workers, 1)
+    parts = [os.path.join(out_dir, f"part-{i:03d}") for i in range(shards)]
+    # Fails here on a bad key rather than in every worker.
+    PacketCipher(key)
+    pool = None
+    with open(capture_path, 'rb') as f:
+        capture = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if workers:
+            pool = _Workers(capture_path, key, parts)
+            batches = _Batches(shards, pool.send)
+        else:
+            local = [Shard(capture_path, key, part) for part in parts]
+            batches = _Batches(shards, lambda shard, batch: local[shard].segments(*batch))
+        reassembler = Reassembler(batches.add)
+        reassembler.feed(capture)
+        reassembler.finish()
+        batches.flush()
+        if workers:
+            stats = pool.finish()
+        else:
+            stats = [shard.close() for shard in local]
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        capture.close()
+    _merge(parts, out_dir)
+
+    totals = {name: sum(s[name] for s in stats) for name in stats[0]}
+    totals['lost_segments'] = reassembler.lost
+    index = {
+        'capture': os.path.abspath(capture_path),
+        'rows': totals.pop('rows'),
+        'columns': {name: dtype for name, (_, dtype) in COLUMNS.items()},
+        'payloads': PAYLOADS,
+        'flows': [{'id': i, 'src': _address(src, sport), 'dst': _address(dst, dport)} for i, (src, sport, dst, dport) in enumerate(reassembler.flows)],
+        'stats': totals,
+    }
+    with open(os.path.join(out_dir, INDEX), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def load(out_dir):
+    # The index and columns written by ingest(), as arrays.
+    with open(os.path.join(out_dir, INDEX)) as f:
+        index = json.load(f)
+    columns = {}
+    for name, (typecode, _) in COLUMNS.items():
+        values = array.array(typecode)
+        with open(os.path.join(out_dir, name), 'rb') as f:
+            values.frombytes(f.read())
+        if sys.byteorder == 'big' and values.itemsize > 1:
+            values.byteswap()
+        columns[name] = values
+    return index, columns
+
+
+def main(argv=None):
+    import argparse
+    from talescrypto import gen_key, load_keyblob
+
+    parser = argparse.ArgumentParser(description="Decrypt every 0xAA frame of a pcap/pcapng capture into columnar files.")
+    parser.add_argument('capture')
+    parser.add_argument('out_dir')
+    parser.add_argument('--seed', type=lambda s: int(s, 0), required=True, help="gen_key seed of the session key")
+    parser.add_argument('--keyblob', default=None)
+    parser.add_argument('-j', '--workers', type=int, default=None, help="worker processes (0: none, default: one per CPU)")
+    args = parser.parse_args(argv)
+    if args.keyblob:
+        load_keyblob(args.keyblob)
+    index = ingest(args.capture, args.out_dir, gen_key(args.seed), args.workers)
+    print(f"{index['rows']} frames in {len(index['flows'])} flows, {index['stats']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+import asyncio
+import logging
+
+from talescrypto import PacketCipher
+from talesframe import FrameDecoder
+
+CLIENT_TO_SERVER = 'c2s'
+SERVER_TO_CLIENT = 's2c'
+PEER = {CLIENT_TO_SERVER: SERVER_TO_CLIENT, SERVER_TO_CLIENT: CLIENT_TO_SERVER}
+
+# A feed that completes at least this many frames is handed to the executor
+# (if the proxy has one) instead of being processed in the event loop.
+BATCH_FRAMES = 32
+
+log = logging.getLogger(__name__)
+
+
+# The *_payload methods skip talescrypto's global hooks (which only know
+# 'in' and 'out'); sessions count packets in proxy.metrics under c2s/s2c.
+def decrypt_frames(cipher, frames):
+    # FrameDecoder only yields whole 0xAA frames.
+    return [cipher.decrypt_payload(frame[4:]) for frame in frames]
+
+
+def encrypt_frames(cipher, payloads, seqs):
+    out = bytearray()
+    for payload, seq in zip(payloads, seqs):
+        size = len(payload) + 1
+        out += bytes((0xAA, size >> 8, size & 0xFF, seq))
+        out += cipher.encrypt_payload(payload)
+    return bytes(out)
+
+
+class Session:
+    """State of one relayed connection.
+
+    Each direction has its own PacketCipher, FrameDecoder and sendindex
+    counter. The counter starts at the first sequence number seen in that
+    direction and is advanced per frame actually sent, so dropped or
+    injected packets keep the receiver's view consistent.
+    """
+
+    def __init__(self, proxy, key, peername):
+        self.proxy = proxy
+        self.peername = peername
+        self.ciphers = {}
+        self.set_key(key)
+        self.decoders = {CLIENT_TO_SERVER: FrameDecoder(), SERVER_TO_CLIENT: FrameDecoder()}
+        if proxy.metrics is not None:
+            for direction, decoder in self.decoders.items():
+                proxy.metrics.track(decoder, direction)
+        self.sendindex = {CLIENT_TO_SERVER: None, SERVER_TO_CLIENT: None}
+        # Transport that receives frames travelling in each direction.
+        self.transports = {CLIENT_TO_SERVER: None, SERVER_TO_CLIENT: None}
+        self._pending = {CLIENT_TO_SERVER: None, SERVER_TO_CLIENT: None}
+        # Output list of the batch whose hook is running, per direction.
+        self._hooked = {CLIENT_TO_SERVER: None, SERVER_TO_CLIENT: None}
+        self.closed = False
+
+    def set_key(self, key, direction=None):
+        cipher = key if isinstance(key, PacketCipher) else PacketCipher(key)
+        for d in (CLIENT_TO_SERVER, SERVER_TO_CLIENT) if direction is None else (direction,):
+            self.ciphers[d] = cipher
+
+    def _next_seqs(self, direction, count):
+        seq = self.sendindex[direction]
+        seqs = [(seq + i) & 0xFF for i in range(count)]
+        self.sendindex[direction] = (seq + count) & 0xFF
+        return seqs
+
+    def _count(self, direction, frames, payloads):
+        metrics = self.proxy.metrics
+        if metrics is not None:
+            for frame, payload in zip(frames, payloads):
+                metrics.packet(direction, len(payload), frame[3], payload[0] if payload else None)
+
+    def _apply_hook(self, direction, payloads):
+        on_packet = self.proxy.on_packet
+        if on_packet is None:
+            return [p for p in payloads if p is not None]
+        out = self._hooked[direction] = []
+        try:
+            for payload in payloads:
+                if payload is not None:
+                    payload = on_packet(self, direction, payload)
+                    if payload is not None:
+                        out.append(payload)
+        finally:
+            self._hooked[direction] = None
+        return out
+
+    def _write(self, direction, data):
+        transport = self.transports[direction]
+        if data and transport is not None and not transport.is_closing():
+            transport.write(data)
+
+    def send(self, direction, payload):
+        # Injects a packet; it is encrypted and numbered like relayed ones.
+        # From on_packet it goes right before the packet being handled,
+        # otherwise behind any batch of that direction still in the executor.
+        hooked = self._hooked[direction]
+        if hooked is not None:
+            hooked.append(payload)
+            return
+        pending = self._pending[direction]
+        if pending is not None and not pending.done():
+            self._schedule(direction, self._send_after(pending, direction, payload))
+            return
+        if self.sendindex[direction] is None:
+            self.sendindex[direction] = 0
+        seq, = self._next_seqs(direction, 1)
+        self._write(direction, encrypt_frames(self.ciphers[direction], [payload], [seq]))
+
+    async def _send_after(self, previous, direction, payload):
+        await previous
+        self.send(direction, payload)
+
+    def _schedule(self, direction, coro):
+        # Runs coro as the direction's pending work; later batches wait for it.
+        task = asyncio.ensure_future(coro)
+        task.add_done_callback(self._done)
+        self._pending[direction] = task
+
+    def _done(self, task):
+        # A failed batch fails every later one of its direction, so the
+        # session is closed (once) rather than left relaying nothing.
+        if task.cancelled() or task.exception() is None or self.closed:
+            return
+        log.error("%s: dropping connection", self.peername, exc_info=task.exception())
+        self.close()
+
+    def data_received(self, direction, data):
+        frames = self.decoders[direction].feed(data)
+        if not frames:
+            return
+        if self.sendindex[direction] is None:
+            self.sendindex[direction] = frames[0][3]
+        pending = self._pending[direction]
+        executor = self.proxy.executor
+        if (pending is None or pending.done()) and (executor is None or len(frames) < self.proxy.batch_frames):
+            # Common case: handled right here, straight from the decoder's views.
+            cipher = self.ciphers[direction]
+            payloads = decrypt_frames(cipher, frames)
+            self._count(direction, frames, payloads)
+            payloads = self._apply_hook(direction, payloads)
+            self._write(direction, encrypt_frames(cipher, payloads, self._next_seqs(direction, len(payloads))))
+            return
+        # The views die with the next feed, so the batch gets its own copy.
+        frames = [bytes(frame) for frame in frames]
+        self._schedule(direction, self._process(pending, direction, frames))
+
+    async def _process(self, previous, direction, frames):
+        if previous is not None:
+            await previous
+        loop = asyncio.get_running_loop()
+        cipher = self.ciphers[direction]
+        payloads = await loop.run_in_executor(self.proxy.executor, decrypt_frames, cipher, frames)
+        self._count(direction, frames, payloads)
+        payloads = self._apply_hook(direction, payloads)
+        seqs = self._next_seqs(direction, len(payloads))
+        data = await loop.run_in_executor(self.proxy.executor, encrypt_frames, cipher, payloads, seqs)
+        self._write(direction, data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for transport in self.transports.values():
+            if transport is not None:
+                transport.close()
+        if self.proxy.metrics is not None:
+            for decoder in self.decoders.values():
+                self.proxy.metrics.untrack(decoder)
+
+
+class _Side(asyncio.Protocol):
+    # One TCP leg of a session; `direction` is where its incoming data goes.
+
+    def __init__(self, session, direction):
+        self.session = session
+        self.direction = direction
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.session.transports[PEER[self.direction]] = transport
+
+    def data_received(self, data):
+        try:
+            self.session.data_received(self.direction, data)
+        except Exception:
+            log.exception("%s: dropping connection", self.session.peername)
+            self.session.close()
+
+    def connection_lost(self, exc):
+        self.session.transports[PEER[self.direction]] = None
+        self.session.close()
+
+    # Backpressure: stop reading the other leg while this one can't keep up.
+    def pause_writing(self):
+        peer = self.session.transports[self.direction]
+        if peer is not None:
+            peer.pause_reading()
+
+    def resume_writing(self):
+        peer = self.session.transports[self.direction]
+        if peer is not None:
+            peer.resume_reading()
+
+
+class _ClientSide(_Side):
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        super().__init__(None, CLIENT_TO_SERVER)
+
+    def connection_made(self, transport):
+        peername = transport.get_extra_info('peername')
+        self.session = Session(self.proxy, self.proxy.key_for(peername), peername)
+        super().connection_made(transport)
+        transport.pause_reading()
+        asyncio.ensure_future(self._connect_upstream())
+
+    async def _connect_upstream(self):
+        loop = asyncio.get_running_loop()
+        try:
+            upstream, _ = await loop.create_connection(lambda: _Side(self.session, SERVER_TO_CLIENT), self.proxy.upstream_host, self.proxy.upstream_port)
+        except OSError as e:
+            log.warning("%s: upstream connect failed: %s", self.session.peername, e)
+            self.transport.close()
+            return
+        if self.transport.is_closing():
+            # The client left while we were connecting.
+            upstream.close()
+            return
+        self.transport.resume_reading()
+
+
+class Proxy:
+    """Relays client connections to an upstream server, decrypting every
+    frame, passing it through ``on_packet(session, direction, payload)`` and
+    re-encrypting it. on_packet returns the payload to send (possibly
+    modified) or None to drop it.
+
+    ``key`` is a session key (as from gen_key) or a callable taking the
+    client's peername and returning one. Large batches go to ``executor``
+    (a thread or process pool) when given. Packet and opcode counts and frame
+    statistics of every session are reported to ``metrics`` (a
+    talesmetrics.Metrics) under the c2s/s2c directions, if given; the proxy
+    does not report to talescrypto's global hooks.
+    """
+
+    def __init__(self, upstream_host, upstream_port, key, on_packet=None, executor=None, batch_frames=BATCH_FRAMES, metrics=None):
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.key_for = key if callable(key) else (lambda peername: key)
+        self.on_packet = on_packet
+        self.executor = executor
+        self.batch_frames = batch_frames
+        self.metrics = metrics
+
+    async def start(self, host='127.0.0.1', port=0):
+        loop = asyncio.get_running_loop()
+        return await loop.create_server(lambda: _ClientSide(self), host, port)
+
+
+def main(argv=None):
+    import argparse
+    from talescrypto import gen_key, load_keyblob
+
+    parser = argparse.ArgumentParser(description="Decrypting relay between a client and a server.")
+    parser.add_argument('upstream', help="server host:port")
+    parser.add_argument('--listen', default='127.0.0.1:0', help="host:port to accept clients on")
+    parser.add_argument('--seed', type=lambda s: int(s, 0), required=True, help="gen_key seed of the session key")
+    parser.add_argument('--keyblob', default=None)
+    args = parser.parse_args(argv)
+    if args.keyblob:
+        load_keyblob(args.keyblob)
+    upstream_host, upstream_port = args.upstream.rsplit(':', 1)
+    host, port = args.listen.rsplit(':', 1)
+    proxy = Proxy(upstream_host, int(upstream_port), gen_key(args.seed))
+
+    async def serve():
+        server = await proxy.start(host, int(port))
+        log.warning("listening on %s", server.sockets[0].getsockname())
+        async with server:
+            await server.serve_forever()
+
+    logging.basicConfig()
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import asyncio
+import concurrent.futures
+import os
+import random
+import tempfile
+import unittest
+
+import talescrypto
+from talescrypto import PacketCipher, gen_key
+from talesframe import FrameDecoder
+from talesmetrics import Metrics
+from talesproxy import CLIENT_TO_SERVER, SERVER_TO_CLIENT, Proxy
+
+FIRST_SEQ = 250
+
+
+def setUpModule():
+    # A synthetic keyblob, as in Benchmarks/bench.py; no game files needed.
+    global KEY, CIPHER, _tmp
+    _tmp = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
+    path = os.path.join(_tmp.name, 'keyblob.bin')
+    with open(path, 'wb') as f:
+        f.write(random.Random('keyblob').randbytes(0x10000 + 0x100))
+    talescrypto.load_keyblob(path)
+    KEY = gen_key(0x12345678)
+    CIPHER = PacketCipher(KEY)
+
+
+def tearDownModule():
+    _tmp.cleanup()
+
+
+class _Server:
+    # Loopback stand-in for the game server: records every frame it gets and
+    # answers each with b'echo' + payload under the same sequence number.
+
+    def __init__(self):
+        self.frames = []
+        self.closed = asyncio.Event()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        decoder = FrameDecoder()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            for frame in decoder.feed(data):
+                payload = CIPHER.decrypt(frame)
+                self.frames.append((frame[3], payload))
+                writer.write(CIPHER.encrypt(b'echo' + payload, frame[3]))
+        writer.close()
+        self.closed.set()
+
+
+class ProxyTest(unittest.IsolatedAsyncioTestCase):
+    executor = None
+
+    async def asyncSetUp(self):
+        self.server = _Server()
+        self.upstream_port = await self.server.start()
+
+    async def asyncTearDown(self):
+        self.server.server.close()
+
+    async def _connect(self, on_packet, batch_frames=4, metrics=None):
+        proxy = Proxy('127.0.0.1', self.upstream_port, KEY, on_packet, executor=self.executor, batch_frames=batch_frames, metrics=metrics)
+        listener = await proxy.start()
+        self.addAsyncCleanup(self._close_listener, listener)
+        return await asyncio.open_connection('127.0.0.1', listener.sockets[0].getsockname()[1])
+
+    @staticmethod
+    async def _close_listener(listener):
+        listener.close()
+        await listener.wait_closed()
+
+    @staticmethod
+    async def _send(writer, payloads, first_seq=FIRST_SEQ, chunk=777):
+        data = b''.join(CIPHER.encrypt(p, (first_seq + i) & 0xFF) for i, p in enumerate(payloads))
+        for pos in range(0, len(data), chunk):
+            writer.write(data[pos:pos + chunk])
+            await writer.drain()
+
+    @staticmethod
+    async def _receive(reader, count):
+        decoder = FrameDecoder()
+        frames = []
+        while len(frames) < count:
+            data = await asyncio.wait_for(reader.read(65536), 5)
+            if not data:
+                break
+            frames.extend((frame[3], CIPHER.decrypt(frame)) for frame in decoder.feed(data))
+        return frames
+
+    def _assert_numbered(self, frames, first_seq):
+        self.assertEqual([seq for seq, _ in frames], [(first_seq + i) & 0xFF for i in range(len(frames))])
+
+    async def test_relay_drop_and_inject(self):
+        def on_packet(session, direction, payload):
+            if direction == CLIENT_TO_SERVER and payload == b'drop':
+                return None
+            if direction == CLIENT_TO_SERVER and payload == b'inject':
+                # Replaces the packet with one the client never sent.
+                session.send(CLIENT_TO_SERVER, b'injected')
+                return None
+            if direction == SERVER_TO_CLIENT and payload == b'echoinjected':
+                session.send(SERVER_TO_CLIENT, b'to client')
+            if direction == SERVER_TO_CLIENT and payload == b'echorewrite':
+                return b'rewritten'
+            return payload
+
+        reader, writer = await self._connect(on_packet)
+        rng = random.Random('relay')
+        payloads = [rng.randbytes(rng.randrange(1, 300)) for _ in range(200)]
+        payloads[3:3] = [b'drop', b'inject', b'', b'rewrite']
+        payloads[150:150] = [b'drop', b'drop', b'inject']
+        await self._send(writer, payloads)
+        relayed = [b'injected' if p == b'inject' else p for p in payloads if p != b'drop']
+
+        replies = await self._receive(reader, len(relayed) + 2)
+        self.assertEqual([p for _, p in self.server.frames], relayed)
+        # Dropped and injected packets leave no hole in the numbering.
+        self._assert_numbered(self.server.frames, FIRST_SEQ)
+        self._assert_numbered(replies, FIRST_SEQ)
+        expected = [b'rewritten' if p == b'rewrite' else b'echo' + p for p in relayed]
+        self.assertEqual([p for _, p in replies if p != b'to client'], expected)
+        self.assertEqual(len(replies), len(relayed) + 2)
+        writer.close()
+        # The client leaving closes the upstream leg too.
+        await asyncio.wait_for(self.server.closed.wait(), 5)
+
+    async def test_failing_hook_closes_session(self):
+        def on_packet(session, direction, payload):
+            if payload == b'bad':
+                raise RuntimeError("hook failed")
+            return payload
+
+        reader, writer = await self._connect(on_packet)
+        payloads = [bytes([i]) * 8 for i in range(30)]
+        payloads[10] = b'bad'
+        with self.assertLogs('talesproxy', 'ERROR'):
+            await self._send(writer, payloads, chunk=1 << 16)
+            # Both legs are closed instead of the session staying open.
+            self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+            await asyncio.wait_for(self.server.closed.wait(), 5)
+        self.assertEqual(self.server.frames, [])
+        writer.close()
+
+
+    async def test_metrics_per_direction(self):
+        metrics, global_hooks = Metrics(), Metrics()
+        talescrypto.set_metrics(global_hooks)
+        self.addCleanup(talescrypto.set_metrics, None)
+        reader, writer = await self._connect(None, metrics=metrics)
+        payloads = [bytes([i % 3]) * (i % 40) for i in range(100)]
+        await self._send(writer, payloads)
+        replies = await self._receive(reader, len(payloads))
+        self.assertEqual(len(replies), len(payloads))
+        writer.close()
+        await asyncio.wait_for(self.server.closed.wait(), 5)
+
+        directions = metrics.snapshot()['directions']
+        self.assertEqual(set(directions), {CLIENT_TO_SERVER, SERVER_TO_CLIENT})
+        self.assertEqual(directions[CLIENT_TO_SERVER]['packets'], len(payloads))
+        self.assertEqual(directions[CLIENT_TO_SERVER]['opcodes'], {'0x00': 33, '0x01': 32, '0x02': 32, 'empty': 3})
+        # Every reply starts with b'echo'.
+        self.assertEqual(directions[SERVER_TO_CLIENT]['opcodes'], {'0x65': len(payloads)})
+        self.assertEqual(metrics.snapshot()['framing'][SERVER_TO_CLIENT]['frames'], len(payloads))
+        # The stand-ins use PacketCipher too, but nothing came from the proxy.
+        self.assertEqual(global_hooks.directions['in'].packets, len(payloads) * 2)
+
+
+class ThreadExecutorProxyTest(ProxyTest):
+
+    def setUp(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(2)
+        self.addCleanup(self.executor.shutdown)
+
+
+if __name__ == '__main__':
+    unittest.main()